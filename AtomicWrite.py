@@ -0,0 +1,53 @@
+# Copyright (C) 2011-2012 by fizzisist <fizzisist@fpgamining.com>
+#                            fpgaminer <fpgaminer@bitcoin-mining.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+# Atomic file replacement, shared by the bitstream cache and the clock tuner.
+
+import os
+import tempfile
+
+
+def atomicWrite(path, write):
+	"""Replace the file at path with what write(f) writes to the open file f.
+	The data goes to a temporary file that is then renamed over path, so a
+	crash can never leave a half-written file behind.
+	"""
+	(fd, tmp_path) = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path) or '.')
+
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			write(f)
+		try:
+			os.rename(tmp_path, path)
+		except OSError:
+			# Windows will not rename over an existing file.
+			_remove(path)
+			os.rename(tmp_path, path)
+	except:
+		_remove(tmp_path)
+		raise
+
+def _remove(path):
+	try:
+		os.remove(path)
+	except OSError:
+		pass
@@ -0,0 +1,126 @@
+# Copyright (C) 2011-2012 by fizzisist <fizzisist@fpgamining.com>
+#                            fpgaminer <fpgaminer@bitcoin-mining.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+# A host-wide cache of pre-processed bitstreams.
+#
+# Entries are content-addressed: the key is a SHA-256 over the raw bitstream,
+# the FT232R pin mapping and the JTAG chain, so a rebuilt bitstream or a
+# different board wiring can never pick up a stale entry. Entries are written
+# atomically (temporary file + rename), and the least recently used ones are
+# evicted once the cache grows past its size limit.
+
+import os
+import errno
+import cPickle as pickle
+from hashlib import sha256
+from AtomicWrite import atomicWrite
+
+# Bump this whenever the format of a processed bitstream changes.
+CACHE_VERSION = 1
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.x6500-miner', 'cache')
+DEFAULT_MAX_SIZE = 1024*1024*1024
+ENTRY_SUFFIX = '.processed'
+
+
+class BitstreamCache:
+	def __init__(self, directory=None, max_size=DEFAULT_MAX_SIZE):
+		self.directory = DEFAULT_CACHE_DIR if directory is None else directory
+		self.max_size = max_size
+
+		try:
+			os.makedirs(self.directory)
+		except OSError, e:
+			if e.errno != errno.EEXIST:
+				raise
+	
+	@staticmethod
+	def key(bitstream, portlist, chain):
+		"""Compute the cache key for bitstream processed for chain with the given FT232R_PortList."""
+		h = sha256()
+		h.update(bitstream)
+		h.update("|v%d|chain=%d|pins=%d,%d,%d,%d,%d,%d,%d,%d" % (CACHE_VERSION, chain,
+			portlist.tck0, portlist.tms0, portlist.tdi0, portlist.tdo0,
+			portlist.tck1, portlist.tms1, portlist.tdi1, portlist.tdo1))
+		return h.hexdigest()
+	
+	def _path(self, key):
+		return os.path.join(self.directory, key + ENTRY_SUFFIX)
+	
+	def load(self, key):
+		"""Return the processed bitstream stored under key, or None on a miss."""
+		path = self._path(key)
+
+		try:
+			with open(path, 'rb') as f:
+				processed_bitstream = pickle.load(f)
+		except IOError:
+			return None
+		except (pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+			# Corrupt entry; drop it and treat it as a miss.
+			self._remove(path)
+			return None
+
+		# Mark the entry as recently used.
+		try:
+			os.utime(path, None)
+		except OSError:
+			pass
+
+		return processed_bitstream
+	
+	def save(self, key, processed_bitstream):
+		"""Atomically store processed_bitstream under key, then evict old entries."""
+		atomicWrite(self._path(key), lambda f: pickle.dump(processed_bitstream, f, pickle.HIGHEST_PROTOCOL))
+		self.evict()
+	
+	def evict(self):
+		"""Remove least recently used entries until the cache fits within max_size."""
+		entries = []
+		total = 0
+
+		for name in os.listdir(self.directory):
+			if not name.endswith(ENTRY_SUFFIX):
+				continue
+			path = os.path.join(self.directory, name)
+			try:
+				st = os.stat(path)
+			except OSError:
+				continue
+			entries.append((st.st_mtime, st.st_size, path))
+			total += st.st_size
+
+		entries.sort()
+
+		# Always keep the most recently used entry, even if it alone is too big.
+		for (mtime, size, path) in entries[:-1]:
+			if total <= self.max_size:
+				break
+			if self._remove(path):
+				total -= size
+	
+	@staticmethod
+	def _remove(path):
+		try:
+			os.remove(path)
+			return True
+		except OSError:
+			return False
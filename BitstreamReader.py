@@ -35,10 +35,46 @@
 # design name, part name, date, time
 # The last field is the raw bitstream.
 #
+# Only the header is parsed when a file is opened. The raw bitstream is
+# memory-mapped the first time it is needed, so files can be validated and
+# indexed without reading megabytes of payload.
+#
+# Files may also be gzip, bzip2 or xz compressed (.bit.gz, .bit.bz2, .bit.xz),
+# in which case the payload is decompressed as it is read. Headerless .bin
+# files (bitgen -g Binary:Yes) are accepted too, but since they carry no
+# header, the part name and UserID must be supplied by the caller.
+#
 
-import os.path
-import cPickle as pickle
+import os
+import sys
+import mmap
 import time
+import gzip
+import bz2
+import ctypes
+import multiprocessing
+from threading import Thread
+from Queue import Queue
+
+try:
+  import lzma
+except ImportError:
+  try:
+    from backports import lzma
+  except ImportError:
+    lzma = None
+
+# Size of each chunk of processed bitstream written to the FT232R.
+# Every bitstream byte expands to 16 bytes (8 JTAG clocks of 2 states each).
+CHUNK_SIZE = 4096*4
+# Number of reusable buffers in the ring used when streaming a bitstream.
+STREAM_BUFFERS = 8
+# Number of raw bitstream bytes handed to a worker process at a time.
+# Must be a multiple of CHUNK_SIZE/16 so ranges line up with chunks.
+PARALLEL_RANGE = 64*1024
+
+# Suffixes of the compressed formats we can read, and how to open them.
+COMPRESSED_FORMATS = {'.gz': gzip.GzipFile, '.bz2': bz2.BZ2File, '.xz': 'lzma'}
 
 # Dictionary for looking up idcodes from device names:
 idcode_lut = {'6slx150fgg484': 0x401d093, '6slx45csg324': 0x4008093, '6slx150tfgg676': 0x403D093}
@@ -53,27 +89,43 @@ class BitFileReadError(Exception):
 class BitFileMismatch(Exception):
   _mismatchMessage = "Device IDCode does not match bitfile IDCode! Was this bitstream built for this FPGA?"
   def __init__(self, value=None):
-    self.parameter = BitFileReadError._mismatchMessage if value is None else value
+    self.parameter = BitFileMismatch._mismatchMessage if value is None else value
   def __str__(self):
     return repr(self.parameter)
     
 class BitFileUnknown(Exception):
   _unknownMessage = "Bitfile has an unknown UserID! Was this bitstream built for the X6500?"
   def __init__(self, value=None):
-    self.parameter = BitFileReadError._unknownMessage if value is None else value
+    self.parameter = BitFileUnknown._unknownMessage if value is None else value
   def __str__(self):
     return repr(self.parameter)
   
 class Object(object):
   pass
 
-class BitFile:
-  """Read a .bit file and return a BitFile object."""
+class BitFile(object):
+  """Read a .bit file's header and return a BitFile object."""
   @staticmethod
-  def read(name):
-    with open(name, 'rb') as f:
-      bitfile = BitFile()
-      
+  def read(name, part=None, userid=None):
+    """part and userid are only used (and are required) for headerless .bin files."""
+    bitfile = BitFile()
+    bitfile.name = name
+    (container, bitfile.compression) = BitFile._splitCompression(name)
+    
+    if container.lower().endswith('.bin'):
+      if part is None or userid is None:
+        raise BitFileReadError("Headerless .bin files need the part name and UserID to be specified.")
+      bitfile.designname = os.path.basename(container)
+      bitfile.date = ''
+      bitfile.time = ''
+      bitfile._setPart(part)
+      bitfile._setUserID(userid)
+      bitfile.offset = 0
+      if bitfile.compression is None:
+        bitfile.length = os.path.getsize(name)
+      return bitfile
+    
+    with BitFile._open(name, bitfile.compression) as f:
       # 11 bytes of unknown data
       if BitFile._readLength(f) != 9:
         raise BitFileReadError()
@@ -83,72 +135,171 @@ class BitFile:
       # the designname field should look something like:
       # fpgaminer_top.ncd;HW_TIMEOUT=FALSE;UserID=0xFFFFFFFF
       bitfile.designname = BitFile._readField(f, 'a').rstrip('\0')
-      bitfile.userid = int(bitfile.designname.split(';')[-1].split('=')[-1], base=16)
-      if bitfile.userid == 0xFFFFFFFF:
-        bitfile.rev = 0
-        bitfile.build = 0
-      elif (bitfile.userid >> 16) & 0xFFFF == 0x4224:
-        bitfile.rev = (bitfile.userid >> 8) & 0xFF
-        bitfile.build = bitfile.userid & 0xFF
-      else:
-        raise BitFileUnknown()
+      bitfile._setUserID(int(bitfile.designname.split(';')[-1].split('=')[-1], base=16))
         
-      bitfile.part = BitFile._readField(f, 'b').rstrip('\0')
+      part = BitFile._readField(f, 'b').rstrip('\0')
       bitfile.date = BitFile._readField(f, 'c').rstrip('\0')
       bitfile.time = BitFile._readField(f, 'd').rstrip('\0')
-      bitfile.idcode = idcode_lut[bitfile.part]
+      bitfile._setPart(part)
       
       if BitFile._readOrDie(f, 1) != 'e':
         raise BitFileReadError()
       
-      length = BitFile._readLength4(f)
-      bitfile.bitstream = BitFile._readOrDie(f, length)
+      bitfile.length = BitFile._readLength4(f)
+      bitfile.offset = f.tell()
       
-      bitfile.processed = [False]*3
-      
-      for i in range(3):
-        processed_name = name + '.' + str(i)
-        if os.path.isfile(processed_name):
-          bitfile.processed[i] = True
+      if bitfile.compression is None and os.fstat(f.fileno()).st_size < bitfile.offset + bitfile.length:
+        raise BitFileReadError()
       
       return bitfile
   
+  def _setUserID(self, userid):
+    self.userid = userid
+    if self.userid == 0xFFFFFFFF:
+      self.rev = 0
+      self.build = 0
+    elif (self.userid >> 16) & 0xFFFF == 0x4224:
+      self.rev = (self.userid >> 8) & 0xFF
+      self.build = self.userid & 0xFF
+    else:
+      raise BitFileUnknown()
+  
+  def _setPart(self, part):
+    self.part = part
+    self.idcode = idcode_lut[part]
+  
+  @staticmethod
+  def _splitCompression(name):
+    """Split a compression suffix off name. Returns (name, suffix or None)."""
+    (base, ext) = os.path.splitext(name)
+    if ext.lower() in COMPRESSED_FORMATS:
+      return (base, ext.lower())
+    return (name, None)
+  
+  @staticmethod
+  def _open(name, compression):
+    if compression is None:
+      return open(name, 'rb')
+    if compression == '.xz':
+      if lzma is None:
+        raise BitFileReadError("Reading .xz files requires the lzma module (pip install backports.lzma).")
+      return lzma.LZMAFile(name, 'rb')
+    return COMPRESSED_FORMATS[compression](name, 'rb')
+  
+  @staticmethod
+  def scan(directory):
+    """Read the headers of every .bit file in directory.
+    Returns a dictionary mapping (part, userid) to a list of BitFiles,
+    newest firmware first. Files that cannot be parsed are skipped.
+    """
+    index = {}
+    
+    for filename in sorted(os.listdir(directory)):
+      if not BitFile._splitCompression(filename)[0].lower().endswith('.bit'):
+        continue
+      try:
+        bitfile = BitFile.read(os.path.join(directory, filename))
+      except (BitFileReadError, BitFileUnknown, KeyError, ValueError, IOError):
+        continue
+      index.setdefault((bitfile.part, bitfile.userid), []).append(bitfile)
+    
+    for bitfiles in index.values():
+      bitfiles.sort(key=lambda b: (b.rev, b.build), reverse=True)
+    
+    return index
+  
   @staticmethod
-  def pre_process(bitstream, jtag, chain, progressCallback=None):
-    CHUNK_SIZE = 4096*4
-    chunk = ""
+  def select(index, idcode):
+    """Pick the newest BitFile from a scan() index that was built for idcode."""
+    best = None
+    
+    for bitfiles in index.values():
+      for bitfile in bitfiles:
+        if bitfile.idcode != idcode & 0x0FFFFFFF:
+          continue
+        if best is None or (bitfile.rev, bitfile.build) > (best.rev, best.build):
+          best = bitfile
+    
+    return best
+  
+  @property
+  def bitstream(self):
+    """The raw bitstream. For uncompressed files this is a read-only buffer
+    over a memory-mapped file; compressed files are decompressed in full.
+    """
+    if self._bitstream is None:
+      if self.compression is None:
+        with open(self.name, 'rb') as f:
+          self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._bitstream = buffer(self._mmap, self.offset, self.length)
+      else:
+        self._bitstream = ''.join(self.iter_payload())
+        self.length = len(self._bitstream)
+    return self._bitstream
+  
+  def iter_payload(self, blocksize=CHUNK_SIZE/16):
+    """Yield the raw bitstream in blocks, decompressing as we go."""
+    if self.compression is None or self._bitstream is not None:
+      bitstream = self.bitstream
+      for offset in range(0, len(bitstream), blocksize):
+        yield bitstream[offset:offset + blocksize]
+      return
+    
+    with BitFile._open(self.name, self.compression) as f:
+      BitFile._readOrDie(f, self.offset)
+      remaining = self.length
+      while remaining is None or remaining > 0:
+        block = f.read(blocksize if remaining is None else min(blocksize, remaining))
+        if not block:
+          if remaining is not None:
+            raise BitFileReadError()
+          break
+        if remaining is not None:
+          remaining -= len(block)
+        yield block
+  
+  def close(self):
+    self._bitstream = None
+    if self._mmap is not None:
+      self._mmap.close()
+      self._mmap = None
+  
+  @staticmethod
+  def clock_table(jtag):
+    """Build a lookup table mapping each byte value to its JTAG clock pattern, MSB first."""
+    table = []
+    for d in range(256):
+      table.append(''.join([jtag._formatJtagClock(tdi=(d >> i) & 1) for i in range(7, -1, -1)]))
+    return table
+  
+  @staticmethod
+  def pre_process(bitstream, jtag, chain, progressCallback=None, processes=1):
+    if processes != 1:
+      return BitFile.pre_process_many(bitstream, [jtag], progressCallback, processes)[0]
+    
+    table = BitFile.clock_table(jtag)
+    step = CHUNK_SIZE / 16
     chunks = []
     
     bytetotal = len(bitstream)
     start_time = time.time()
     last_update = 0
     written = 0
+    end = bytetotal - 1
 
-    for b in bitstream[:-1]:
-      d = ord(b)
-      
-      for i in range(7, -1, -1):
-        x = (d >> i) & 1
-        chunk += jtag._formatJtagClock(tdi=x)
-          
-        if len(chunk) >= CHUNK_SIZE:
-          chunks.append(chunk)
-          chunk = ""
+    while written < end:
+      segment = bitstream[written:min(written + step, end)]
+      chunks.append(''.join([table[ord(b)] for b in segment]))
       
-      written += 1
+      written += len(segment)
       if time.time() > (last_update + 1) and progressCallback:
         progressCallback(start_time, time.time(), written, bytetotal)
         last_update = time.time()
-    
-    if len(chunk) > 0:
-      chunks.append(chunk)
 
-    last_bits = []
-    d = ord(bitstream[-1])
-    for i in range(7, -1, -1):
-      last_bits.append((d >> i) & 1)
+    last_bits = BitFile._lastBits(bitstream)
     
-    progressCallback(start_time, time.time(), bytetotal, bytetotal)
+    if progressCallback:
+      progressCallback(start_time, time.time(), bytetotal, bytetotal)
 
     #for i in range(self.current_part):
     #  last_bits.append(0)
@@ -160,15 +311,96 @@ class BitFile:
     return processed_bitstream
   
   @staticmethod
-  def save_processed(name, processed_bitstream, chain):
-    processed_name = name.split('.')[0] + ".bit." + str(chain)
-    if processed_bitstream is not None:
-      pickle.dump(processed_bitstream, open(processed_name, "wb"), pickle.HIGHEST_PROTOCOL)
+  def pre_process_many(bitstream, jtags, progressCallback=None, processes=None):
+    """Pre-process bitstream for several JTAG chains (or pin mappings) at once.
+    The bitstream is split into ranges that are expanded in parallel by a pool
+    of worker processes, directly into shared memory. Returns a list of
+    processed bitstreams, in the same order as jtags.
+    
+    The shared output and the chunks copied out of it are both held until this
+    returns, so peak memory is about twice that of pre_process.
+    
+    NOTE: On Windows, the calling script must guard its entry point with
+    if __name__ == '__main__', since worker processes re-import it. There is no
+    fork there either, so the workers' arguments are pickled, and a bitstream
+    that is a buffer over a memory-mapped file is first copied into a string.
+    """
+    tables = [BitFile.clock_table(jtag) for jtag in jtags]
+    bytetotal = len(bitstream)
+    end = bytetotal - 1
+    variant_size = end * 16
+    output = multiprocessing.RawArray(ctypes.c_char, max(variant_size * len(jtags), 1))
+    
+    tasks = []
+    for variant in range(len(jtags)):
+      for offset in range(0, end, PARALLEL_RANGE):
+        tasks.append((variant, variant * variant_size + offset * 16, offset, min(offset + PARALLEL_RANGE, end)))
+    
+    start_time = time.time()
+    last_update = 0
+    written = 0
+    total = end * len(jtags)
+    
+    # Workers get the bitstream once, when they start, rather than with every range.
+    # Without fork that means pickling it, which buffers don't support.
+    if sys.platform == 'win32' and not isinstance(bitstream, str):
+      bitstream = str(bitstream)
+    pool = multiprocessing.Pool(processes, _initExpandWorker, (output, tables, bitstream))
+    try:
+      for count in pool.imap_unordered(_expandRange, tasks):
+        written += count
+        if time.time() > (last_update + 1) and progressCallback:
+          progressCallback(start_time, time.time(), written, total)
+          last_update = time.time()
+      pool.close()
+    except:
+      pool.terminate()
+      raise
+    finally:
+      pool.join()
+    
+    if progressCallback:
+      progressCallback(start_time, time.time(), total, total)
+    
+    last_bits = BitFile._lastBits(bitstream)
+    address = ctypes.addressof(output)
+    processed_bitstreams = []
+    
+    for variant in range(len(jtags)):
+      base = variant * variant_size
+      processed_bitstream = Object()
+      processed_bitstream.chunks = [ctypes.string_at(address + base + offset, min(CHUNK_SIZE, variant_size - offset))
+                                    for offset in range(0, variant_size, CHUNK_SIZE)]
+      processed_bitstream.last_bits = list(last_bits)
+      processed_bitstreams.append(processed_bitstream)
+    
+    return processed_bitstreams
   
   @staticmethod
-  def load_processed(name, chain):
-    processed_name = name + "." + str(chain)
-    return pickle.load(open(processed_name, "rb"))
+  def stream_process(bitstream, jtag, buffers=STREAM_BUFFERS):
+    """Start expanding bitstream in the background and return a StreamedBitstream.
+    Can be passed to JTAG.load_bitstream in place of a pre-processed bitstream.
+    bitstream may be a string or buffer, or a BitFile whose payload will then
+    be read (and decompressed) incrementally.
+    """
+    if isinstance(bitstream, BitFile):
+      blocks = bitstream.iter_payload()
+      length = bitstream.length
+    else:
+      blocks = (bitstream[i:i + CHUNK_SIZE/16] for i in range(0, len(bitstream), CHUNK_SIZE/16))
+      length = len(bitstream)
+    
+    streamed = StreamedBitstream(blocks, length, BitFile.clock_table(jtag), buffers)
+    streamed.start()
+    return streamed
+  
+  @staticmethod
+  def _lastBits(bitstream):
+    last_bits = []
+    d = ord(bitstream[-1])
+    for i in range(7, -1, -1):
+      last_bits.append((d >> i) & 1)
+    return last_bits
   
   # Read a 2-byte, unsigned, Big Endian length.
   @staticmethod
@@ -205,7 +437,9 @@ class BitFile:
     
 
   def __init__(self):
+    self.name = None
     self.designname = None
+    self.userid = None
     self.rev = None
     self.build = None
     self.part = None
@@ -213,5 +447,99 @@ class BitFile:
     self.time = None
     self.length = None
     self.idcode = None
-    self.bitstream = None
+    self.offset = None
+    self.compression = None
+    self._bitstream = None
+    self._mmap = None
+
+
+# Worker process state for BitFile.pre_process_many
+_expand_output = None
+_expand_tables = None
+_expand_bitstream = None
+
+def _initExpandWorker(output, tables, bitstream):
+  global _expand_output, _expand_tables, _expand_bitstream
+  _expand_output = output
+  _expand_tables = tables
+  _expand_bitstream = bitstream
+
+def _expandRange(args):
+  """Expand a range of raw bitstream bytes into its place in the shared output."""
+  (variant, position, first, last) = args
+  table = _expand_tables[variant]
+  expanded = ''.join([table[ord(b)] for b in buffer(_expand_bitstream, first, last - first)])
+  ctypes.memmove(ctypes.addressof(_expand_output) + position, expanded, len(expanded))
+  return last - first
+
 
+class StreamedBitstream:
+  """A processed bitstream that is generated while it is being written.
+  
+  A producer thread expands the raw bitstream into a fixed ring of reusable
+  buffers, and the consumer (JTAG.load_bitstream) iterates over chunks, handing
+  each buffer back once it has been written. Memory use is bounded by the ring
+  size, and there is no separate pre-processing phase.
+  """
+  def __init__(self, blocks, length, table, buffers=STREAM_BUFFERS):
+    self.blocks = blocks
+    self.table = table
+    self.bytetotal = None if length is None else length - 1
+    self.last_bits = None
+    self.chunks = None
+    self.error = None
+    self._free = Queue()
+    self._full = Queue()
+    self._producer = None
+    
+    for i in range(buffers):
+      self._free.put(bytearray(CHUNK_SIZE))
+  
+  def start(self):
+    self.chunks = self._consume()
+    self._producer = Thread(target=self._produce)
+    self._producer.daemon = True
+    self._producer.start()
+  
+  def _produce(self):
+    try:
+      # Hold back the most recent block, since the very last byte is
+      # clocked out separately (see JTAG.load_bitstream).
+      pending = None
+      for block in self.blocks:
+        if len(block) == 0:
+          continue
+        if pending is not None:
+          self._fill(pending)
+        pending = block
+      
+      if pending is None:
+        raise BitFileReadError("Bitstream is empty.")
+      
+      self._fill(pending[:-1])
+      self.last_bits = BitFile._lastBits(pending)
+    except Exception, e:
+      self.error = e
+    finally:
+      self._full.put((None, 0))
+  
+  def _fill(self, segment):
+    if len(segment) == 0:
+      return
+    table = self.table
+    length = len(segment) * 16
+    buf = self._free.get()
+    buf[:length] = ''.join([table[ord(b)] for b in segment])
+    self._full.put((buf, length))
+  
+  def _consume(self):
+    while True:
+      (buf, length) = self._full.get()
+      if buf is None:
+        break
+      yield buffer(buf, 0, length)
+      # The writer is done with the previous chunk once it asks for the next one.
+      self._free.put(buf)
+    
+    if self.error is not None:
+      raise self.error
@@ -0,0 +1,132 @@
+# Copyright (C) 2011-2012 by fizzisist <fizzisist@fpgamining.com>
+#                            fpgaminer <fpgaminer@bitcoin-mining.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+# Helpers for building work on the host, for protocols (stratum,
+# getblocktemplate) that hand out block templates rather than getwork units.
+#
+# The FPGA needs the SHA-256 state after the header's first 64-byte block
+# (the midstate). hashlib doesn't expose that, so the compression function
+# is implemented here. makeWork turns an 80-byte header into the same
+# midstate/data/target dict a getwork server returns, so FPGA.putJob and
+# everything after it doesn't need to know where work came from.
+
+from struct import pack, unpack
+from hashlib import sha256
+
+# Pool difficulty 1 target
+DIFF1_TARGET = 0xFFFF << 208
+
+K = (
+	0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+	0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+	0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+	0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+	0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+	0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+	0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+	0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2,
+)
+
+IV = (0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19)
+
+# SHA-256 padding for an 80-byte message, which makes up the rest of getwork's 128 bytes of data
+HEADER_PADDING = '\x80' + '\x00'*39 + pack('>Q', 80*8)
+
+
+def _rotr(x, n):
+	return ((x >> n) | (x << (32 - n))) & 0xFFFFFFFF
+
+def sha256Compress(state, block):
+	"""Run the SHA-256 compression function on one 64-byte block.
+	state is a tuple of eight 32-bit words; the new state is returned.
+	"""
+	w = list(unpack('>16I', block))
+	for i in range(16, 64):
+		s0 = _rotr(w[i-15], 7) ^ _rotr(w[i-15], 18) ^ (w[i-15] >> 3)
+		s1 = _rotr(w[i-2], 17) ^ _rotr(w[i-2], 19) ^ (w[i-2] >> 10)
+		w.append((w[i-16] + s0 + w[i-7] + s1) & 0xFFFFFFFF)
+
+	(a, b, c, d, e, f, g, h) = state
+
+	for i in range(64):
+		s1 = _rotr(e, 6) ^ _rotr(e, 11) ^ _rotr(e, 25)
+		ch = (e & f) ^ (~e & g)
+		t1 = (h + s1 + ch + K[i] + w[i]) & 0xFFFFFFFF
+		s0 = _rotr(a, 2) ^ _rotr(a, 13) ^ _rotr(a, 22)
+		maj = (a & b) ^ (a & c) ^ (b & c)
+		t2 = (s0 + maj) & 0xFFFFFFFF
+
+		(h, g, f, e, d, c, b, a) = (g, f, e, (d + t1) & 0xFFFFFFFF, c, b, a, (t1 + t2) & 0xFFFFFFFF)
+
+	return tuple((x + y) & 0xFFFFFFFF for (x, y) in zip(state, (a, b, c, d, e, f, g, h)))
+
+def doubleSha(data):
+	return sha256(sha256(data).digest()).digest()
+
+def swap32(data):
+	"""Byte swap every 32-bit word of data."""
+	count = len(data) / 4
+	return pack('>%dI' % count, *unpack('<%dI' % count, data))
+
+def merkleRoot(coinbase, branches):
+	"""The merkle root of a block whose coinbase transaction is coinbase, given
+	the merkle branch (a list of raw 32-byte hashes) from it to the root.
+	"""
+	root = doubleSha(coinbase)
+	for branch in branches:
+		root = doubleSha(root + branch)
+	return root
+
+def merkleBranch(hashes):
+	"""The merkle branch from a block's coinbase transaction to its merkle root,
+	given the (raw, internal byte order) hashes of the block's other transactions.
+	"""
+	branch = []
+	level = [None] + hashes
+	while len(level) > 1:
+		branch.append(level[1])
+		if len(level) % 2 == 1:
+			level.append(level[-1])
+		level = [None] + [doubleSha(level[i] + level[i+1]) for i in range(2, len(level), 2)]
+	return branch
+
+def difficultyTarget(difficulty):
+	"""The share target for a pool difficulty."""
+	return min(2**256 - 1, int(DIFF1_TARGET / difficulty))
+
+def bitsTarget(bits):
+	"""The target encoded by a block header's compact nBits field."""
+	return (bits & 0xFFFFFF) << (8 * ((bits >> 24) - 3))
+
+def makeHeader(version, prevhash, merkle_root, ntime, bits, nonce=0):
+	"""Serialize an 80-byte block header. prevhash and merkle_root are raw, in internal byte order."""
+	return pack('<I32s32sIII', version, prevhash, merkle_root, ntime, bits, nonce)
+
+def makeWork(header, target):
+	"""Build a getwork style work unit from an 80-byte header and an integer share target."""
+	state = sha256Compress(IV, header[:64])
+
+	return {
+		'data': swap32(header + HEADER_PADDING).encode('hex'),
+		'midstate': pack('<8I', *state).encode('hex'),
+		'target': ('%064x' % target).decode('hex')[::-1].encode('hex'),
+	}
@@ -0,0 +1,203 @@
+# Copyright (C) 2011-2012 by fizzisist <fizzisist@fpgamining.com>
+#                            fpgaminer <fpgaminer@bitcoin-mining.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+# Finds the best clock speed for each FPGA while mining.
+#
+# Each FPGA's clock is raised one step at a time. Every step is held for a
+# measurement window long enough to see a useful number of nonces, and is
+# scored by its effective hashrate: the clock speed scaled by the fraction of
+# nonces that were valid. Once a step's error rate crosses the threshold, or
+# its score is no better than the best so far, the FPGA goes back to the best
+# clock and stays there. The best clock is saved per board serial and chain,
+# so later runs start from it instead of ramping again. A settled FPGA is
+# still watched, and is stepped down if its error rate climbs.
+
+import os
+import json
+import time
+import errno
+from AtomicWrite import atomicWrite
+
+DEFAULT_STATE_FILE = os.path.join(os.path.expanduser('~'), '.x6500-miner', 'clocks.json')
+
+# Clock step, in MHz.
+CLOCK_STEP = 5
+# Highest clock the tuner will try unless told otherwise, in MHz.
+DEFAULT_MAX_CLOCK = 250
+# The tuner never steps an FPGA below this clock, in MHz.
+MIN_CLOCK = 50
+# Clock used as a starting point if the FPGA's current one is unknown, in MHz.
+DEFAULT_START_CLOCK = 200
+# Highest acceptable fraction of invalid nonces.
+ERROR_THRESHOLD = 0.02
+# A measurement window ends once it has seen this many nonces (valid or not),
+# and lasted at least MIN_WINDOW_TIME seconds.
+WINDOW_NONCES = 100
+MIN_WINDOW_TIME = 60
+# A window that sees fewer than this fraction of the nonces expected at its
+# clock speed is treated as failed; badly overclocked FPGAs often find nothing.
+MIN_NONCE_FRACTION = 0.5
+
+RAMPING = 'ramping'
+SETTLED = 'settled'
+
+
+class TunerState(object):
+	__slots__ = ('state', 'clock', 'best_clock', 'best_score', 'window_start', 'window_valids', 'window_invalids')
+
+
+class ClockTuner:
+	def __init__(self, fpga_list, serial, logger, path=None, max_clock=DEFAULT_MAX_CLOCK):
+		self.fpga_list = fpga_list
+		self.serial = serial
+		self.logger = logger
+		self.path = DEFAULT_STATE_FILE if path is None else path
+		self.max_clock = max_clock
+		self.states = {}
+	
+	def start(self):
+		"""Put every FPGA on its saved clock, or start ramping it from its current one."""
+		saved = self._load().get(self.serial, {})
+
+		for fpga in self.fpga_list:
+			# Old firmware has no clock register.
+			if fpga.firmware_rev == 0:
+				continue
+
+			s = TunerState()
+			s.best_score = 0
+
+			clock = saved.get(str(fpga.chain))
+			if clock is not None:
+				s.state = SETTLED
+				s.clock = min(clock, self.max_clock)
+				s.best_clock = s.clock
+				self.logger.log("FPGA %d: Using saved clock of %dMHz" % (fpga.id, s.clock), False)
+			else:
+				s.state = RAMPING
+				s.clock = min(fpga.clock_speed or DEFAULT_START_CLOCK, self.max_clock)
+				s.best_clock = None
+				self.logger.log("FPGA %d: Tuning clock, starting at %dMHz" % (fpga.id, s.clock), False)
+
+			self.states[fpga.id] = s
+			self._setClock(fpga, s, s.clock)
+	
+	def update(self):
+		"""Evaluate any FPGA whose measurement window is complete. Call this periodically."""
+		now = time.time()
+
+		for fpga in self.fpga_list:
+			s = self.states.get(fpga.id)
+			if s is None:
+				continue
+
+			# Measurements taken while the FPGA is being throttled are meaningless.
+			if fpga.throttle is not None:
+				self._startWindow(fpga, s)
+				continue
+
+			valids = fpga.valid_count - s.window_valids
+			invalids = fpga.invalid_count - s.window_invalids
+			elapsed = now - s.window_start
+			expected = s.clock * 1e6 * elapsed / 2**32
+
+			if elapsed < MIN_WINDOW_TIME:
+				continue
+			if valids + invalids < WINDOW_NONCES:
+				if expected < WINDOW_NONCES / MIN_NONCE_FRACTION:
+					continue
+				# Far too few nonces; count the missing ones as errors.
+				invalids += int(expected) - valids - invalids
+
+			error_rate = float(invalids) / (valids + invalids)
+
+			if s.state == RAMPING:
+				self._ramp(fpga, s, error_rate)
+			elif error_rate > ERROR_THRESHOLD:
+				self.logger.log("FPGA %d: Error rate %.1f%% at %dMHz, stepping down" % (fpga.id, 100*error_rate, s.clock))
+				s.best_clock = max(MIN_CLOCK, s.clock - CLOCK_STEP)
+				self._setClock(fpga, s, s.best_clock)
+				self._save()
+			else:
+				self._setClock(fpga, s, s.clock)
+	
+	def _ramp(self, fpga, s, error_rate):
+		score = s.clock * (1 - error_rate)
+
+		if error_rate <= ERROR_THRESHOLD and score > s.best_score:
+			s.best_clock = s.clock
+			s.best_score = score
+
+			if s.clock + CLOCK_STEP <= self.max_clock:
+				self.logger.log("FPGA %d: %dMHz is stable (%.1f%% errors), trying %dMHz" % (fpga.id, s.clock, 100*error_rate, s.clock + CLOCK_STEP))
+				self._setClock(fpga, s, s.clock + CLOCK_STEP)
+				return
+
+		if s.best_clock is None:
+			# Even the starting clock is unstable; keep stepping down.
+			self.logger.log("FPGA %d: Error rate %.1f%% at %dMHz, stepping down" % (fpga.id, 100*error_rate, s.clock))
+			self._setClock(fpga, s, max(MIN_CLOCK, s.clock - CLOCK_STEP))
+			return
+
+		self.logger.log("FPGA %d: Settled on %dMHz" % (fpga.id, s.best_clock))
+		s.state = SETTLED
+		self._setClock(fpga, s, s.best_clock)
+		self._save()
+	
+	def _setClock(self, fpga, s, clock):
+		s.clock = clock
+		self._startWindow(fpga, s)
+
+		if fpga.clock_speed != clock:
+			fpga.setClockSpeed(clock)
+	
+	def _startWindow(self, fpga, s):
+		s.window_start = time.time()
+		s.window_valids = fpga.valid_count
+		s.window_invalids = fpga.invalid_count
+	
+	def _load(self):
+		try:
+			with open(self.path, 'rb') as f:
+				return json.load(f)
+		except IOError:
+			return {}
+		except ValueError:
+			self.logger.log("WARNING: Ignoring corrupt clock file %s" % self.path, False)
+			return {}
+	
+	def _save(self):
+		saved = self._load()
+		clocks = saved.setdefault(self.serial, {})
+		for fpga in self.fpga_list:
+			s = self.states.get(fpga.id)
+			if s is not None and s.state == SETTLED:
+				clocks[str(fpga.chain)] = s.best_clock
+
+		directory = os.path.dirname(self.path)
+		try:
+			os.makedirs(directory)
+		except OSError, e:
+			if e.errno != errno.EEXIST:
+				raise
+
+		atomicWrite(self.path, lambda f: json.dump(saved, f, indent=1, sort_keys=True))
@@ -69,6 +69,14 @@ def formatTime(seconds):
 		time_string += '%ds' % seconds
 	
 	return time_string
+
+def formatTemperature(fpga):
+	"""Describe an FPGA's temperature and throttle state, like 67.2C (throttled)"""
+	if fpga.temperature is None:
+		return '--C'
+	if fpga.throttle is None:
+		return '%.1fC' % fpga.temperature
+	return '%.1fC (%s)' % (fpga.temperature, fpga.throttle)
 	
 class ConsoleLogger(object):
 	"""This class will handle printing messages to the console."""
@@ -82,6 +90,7 @@ class ConsoleLogger(object):
 
 	def __init__(self, verbose=False): 
 		self.fpga_list = []
+		self.verifier = None
 		self.verbose = verbose
 		self.lastUpdate = time() - 1
 		self.start_time = time()
@@ -157,6 +166,10 @@ class ConsoleLogger(object):
 		self.fpga_list[fpgaID].nonce_count += 1
 		self.reportDebug('%d: Golden nonce found' % fpgaID)
 	  
+	def reportDuplicate(self, hash, fpgaID):
+		self.fpga_list[fpgaID].duplicate_count += 1
+		self.reportDebug('%d: Duplicate nonce %s suppressed' % (fpgaID, hash))
+	  
 	def reportFound(self, hash, accepted, fpgaID):
 		if accepted is not None and accepted == True:
 			self.fpga_list[fpgaID].accepted_count += 1
@@ -243,6 +256,19 @@ class ConsoleLogger(object):
 			self.say('  Accepted: %d' % accepted, True, True)
 			self.say('  Rejected: %d (%.2f%%)' % (rejected, rejected_pct), True, True)
 			self.say('  Invalid: %d (%.2f%%)' % (invalids, invalid_pct), True, True)
+			self.say('  Duplicates suppressed: %d' % fpga.duplicate_count, True, True)
+			self.say('  Time spent on exhausted jobs: %s' % formatTime(fpga.wasted_time), True, True)
+			if fpga.temperature is not None:
+				self.say('  Last temperature: %s' % formatTemperature(fpga), True, True)
+			try:
+				empty_pct = 100. * fpga.empty_polls / fpga.poll_count
+				latency = 1000. * fpga.poll_latency / fpga.poll_count
+			except ZeroDivisionError:
+				empty_pct = 0
+				latency = 0
+			self.say('  Nonce polls: %d (%.2f%% empty), average latency %.1f ms' % (fpga.poll_count, empty_pct, latency), True, True)
+			if fpga.verify_writes:
+				self.say('  Job writes verified: %d, readback mismatches: %d' % (fpga.verified_writes, fpga.failed_verifies), True, True)
 			
 			self.say('  Hashrate (all nonces): %sH/s' % (formatNumber(pow(2,32)*nonces/(secs*1000))),
 			         True, True)
@@ -251,6 +277,11 @@ class ConsoleLogger(object):
 			self.say('  Hashrate (accepted shares): %sH/s' % (formatNumber(pow(2,32)*accepted/(secs*1000))),
 			         True, True)
 		
+		if self.verifier is not None:
+			self.say('Nonces checked: %d, latency %.1f ms average / %.1f ms max, queue depth %d max' % (self.verifier.checked,
+			         1000*self.verifier.averageLatency(), 1000*self.verifier.max_latency, self.verifier.max_depth),
+			         True, True)
+		
 		self.say('Total hashrate for device: %sH/s / %sH/s / %sH/s' % (
 		         formatNumber(pow(2,32)*total_nonces/(secs*1000)),
 		         formatNumber(pow(2,32)*total_valids/(secs*1000)),
@@ -276,7 +307,9 @@ class ConsoleLogger(object):
 						inv_pct = 100.*inv/tot
 					except ZeroDivisionError:
 						inv_pct = 0
-					status += ' | %d: %d/%d/%d %.1f%%/%.1f%%' % (fpga.id, acc, rej, inv, rej_pct, inv_pct)
+					status += ' | %d: %d/%d/%d %.1f%%/%.1f%% %s' % (fpga.id, acc, rej, inv, rej_pct, inv_pct, formatTemperature(fpga))
+				if self.verifier is not None:
+					status += ' | queue %d, %.0fms' % (self.verifier.depth(), 1000*self.verifier.averageLatency())
 				status += ' | ' + formatTime(time()-self.start_time)
 				status += ' | ' + self.serial
 			else:
@@ -293,6 +326,8 @@ class ConsoleLogger(object):
 				except ZeroDivisionError:
 					inv_pct = 0
 				status += ' | %d/%d/%d %.2f%%/%.2f%%' % (acc, rej, inv, rej_pct, inv_pct)
+				if any(fpga.temperature is not None for fpga in self.fpga_list):
+					status += ' | ' + ' '.join([formatTemperature(fpga) for fpga in self.fpga_list])
 				#status += ' ' + self.sparkline
 			self.say(status)
 			self.lastUpdate = time()
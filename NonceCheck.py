@@ -0,0 +1,121 @@
+# Copyright (C) 2011-2012 by fizzisist <fizzisist@fpgamining.com>
+#                            fpgaminer <fpgaminer@bitcoin-mining.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+# Verifies the nonces an FPGA reports.
+#
+# Everything about a job that doesn't depend on the nonce is worked out once,
+# when the job is created: the block header is byte swapped into hashing
+# order, its first 64-byte block is run through SHA-256, and the targets are
+# turned into integers. Checking a nonce then costs one SHA-256 compression
+# for the rest of the header, one full SHA-256 of the result, and integer
+# comparisons.
+#
+# Run this module directly to benchmark it.
+
+from struct import pack, unpack
+from hashlib import sha256
+
+# The most a hash can be and still be a valid (difficulty 1) nonce.
+DIFF1_TARGET = 2**224 - 1
+
+
+# Hashes are compared as 256-bit little endian integers.
+def hash2int(h):
+	return int(h[::-1].encode('hex'), 16)
+
+
+class JobHeader(object):
+	__slots__ = ('header', 'target', 'prefix')
+
+	def __init__(self, data, target):
+		# getwork data holds the header as little endian words; hashing wants
+		# them big endian. Only the first 76 bytes are fixed; the nonce follows.
+		words = unpack('<19I', data.decode('hex')[:76])
+		self.header = pack('>19I', *words)
+		self.target = hash2int(target.decode('hex'))
+		self._hashPrefix()
+	
+	def _hashPrefix(self):
+		self.prefix = sha256(self.header[:64])
+	
+	# sha256 objects can't be pickled; rebuild the prefix instead.
+	def __getstate__(self):
+		return (self.header, self.target)
+	
+	def __setstate__(self, state):
+		(self.header, self.target) = state
+		self._hashPrefix()
+	
+	def hash(self, nonce):
+		"""The block hash for nonce, as an integer."""
+		h = self.prefix.copy()
+		h.update(self.header[64:] + pack('>I', nonce))
+		return hash2int(sha256(h.digest()).digest())
+	
+	def check(self, nonce):
+		"""Returns (valid, share): whether nonce is a valid difficulty 1 nonce,
+		and whether it also meets the job's target.
+		"""
+		h = self.hash(nonce)
+		return (h <= DIFF1_TARGET, h <= self.target)
+
+
+if __name__ == '__main__':
+	import os
+	import time
+
+	BASE_TARGET = 'ffffffffffffffffffffffffffffffffffffffffffffffffffffffff00000000'.decode('hex')
+
+	# The original implementation, for comparison.
+	def checkTarget(target, hashOutput):
+		for t,h in zip(target[::-1], hashOutput[::-1]):
+			if ord(t) > ord(h):
+				return True
+			elif ord(t) < ord(h):
+				return False
+		return True
+
+	def checkNonce(data, target, nonce):
+		staticDataUnpacked = unpack('<' + 'I'*19, data.decode('hex')[:76])
+		staticData = pack('>' + 'I'*19, *staticDataUnpacked)
+		hashInput = pack('>76sI', staticData, nonce)
+		hashOutput = sha256(sha256(hashInput).digest()).digest()
+		return (checkTarget(BASE_TARGET, hashOutput), checkTarget(target.decode('hex'), hashOutput))
+
+	COUNT = 100000
+	data = os.urandom(128).encode('hex')
+	target = ('ff' * 26 + '00' * 6)
+	nonces = [unpack('<I', os.urandom(4))[0] for i in range(COUNT)]
+
+	start = time.time()
+	old = [checkNonce(data, target, nonce) for nonce in nonces]
+	old_time = time.time() - start
+
+	start = time.time()
+	header = JobHeader(data, target)
+	new = [header.check(nonce) for nonce in nonces]
+	new_time = time.time() - start
+
+	assert old == new, "Results differ!"
+
+	print "Original:      %8d nonces/s" % (COUNT / old_time)
+	print "Precomputed:   %8d nonces/s (%.1fx)" % (COUNT / new_time, old_time / new_time)
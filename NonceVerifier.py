@@ -0,0 +1,205 @@
+# Copyright (C) 2011-2012 by fizzisist <fizzisist@fpgamining.com>
+#                            fpgaminer <fpgaminer@bitcoin-mining.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+# The stage between the FPGAs and the pool: every nonce an FPGA reports is
+# checked here, counted as valid or invalid, and passed on to the gold queue
+# if it meets the job's target.
+#
+# By default nonces are checked on a single thread. On big rigs that can't
+# keep up, the checks can be farmed out to a process pool instead. Nonces are
+# sent to the pool in batches, and the results are handled in the order the
+# nonces arrived, so the per-FPGA statistics come out the same either way.
+
+import time
+import signal
+from collections import OrderedDict
+from threading import Thread, Lock
+from Queue import Queue, Full
+from multiprocessing import Pool
+
+# Most nonces waiting to be checked before FPGAs start losing them.
+NONCE_QUEUE_SIZE = 4096
+# Most nonces sent to the process pool in one batch.
+BATCH_SIZE = 256
+# Batches in flight per pool process.
+BATCHES_PER_PROCESS = 2
+# Jobs remembered by the duplicate filter.
+DEDUP_JOBS = 64
+
+
+def _initWorker():
+	# Leave Ctrl-C to the main process.
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _checkNonce(item):
+	(header, nonce) = item
+	return header.check(nonce)
+
+
+class DuplicateFilter:
+	"""Remembers the nonces seen for the most recent jobs.
+	The same nonce can be read twice, e.g. across a job switch or when clearing
+	the FIFO doesn't quite empty it. Jobs are keyed by their block header, and
+	the least recently used job is forgotten once max_jobs are remembered.
+	"""
+	def __init__(self, max_jobs=DEDUP_JOBS):
+		self.max_jobs = max_jobs
+		self.jobs = OrderedDict()
+		self.lock = Lock()
+	
+	def add(self, job, nonce):
+		"""Record nonce as found for job. Returns False if it already was."""
+		key = job.header.header
+
+		with self.lock:
+			nonces = self.jobs.pop(key, None)
+			if nonces is None:
+				nonces = set()
+				if len(self.jobs) >= self.max_jobs:
+					self.jobs.popitem(last=False)
+			self.jobs[key] = nonces
+
+			if nonce in nonces:
+				return False
+			nonces.add(nonce)
+			return True
+	
+	def discard(self, job, nonce):
+		"""Forget nonce for job, e.g. when it couldn't be passed on after all."""
+		with self.lock:
+			nonces = self.jobs.get(job.header.header)
+			if nonces is not None:
+				nonces.discard(nonce)
+
+
+class NonceVerifier:
+	def __init__(self, logger, goldqueue, processes=0):
+		self.logger = logger
+		self.goldqueue = goldqueue
+		self.processes = processes
+		self.noncequeue = Queue(NONCE_QUEUE_SIZE)
+		self.dedup = DuplicateFilter()
+		self.pool = None
+		self.inflight = None
+
+		self.stats_lock = Lock()
+		self.checked = 0
+		self.total_latency = 0.0
+		self.max_latency = 0.0
+		self.max_depth = 0
+	
+	def start(self):
+		if self.processes > 0:
+			self.pool = Pool(self.processes, _initWorker)
+			self.inflight = Queue(self.processes * BATCHES_PER_PROCESS)
+
+			collector = Thread(target=self._collectLoop)
+			collector.daemon = True
+			collector.start()
+
+		dispatcher = Thread(target=self._dispatchLoop)
+		dispatcher.daemon = True
+		dispatcher.start()
+	
+	def close(self):
+		if self.pool is not None:
+			self.pool.terminate()
+			self.pool = None
+	
+	def put(self, gold, timeout=10):
+		"""Queue gold (with job, nonce and fpgaID set) to be checked. Returns False if
+		it is a duplicate of a nonce already seen for the job, and raises Queue.Full if
+		it couldn't be queued within timeout seconds."""
+		if not self.dedup.add(gold.job, gold.nonce):
+			return False
+
+		gold.found_time = time.time()
+		try:
+			self.noncequeue.put(gold, block=True, timeout=timeout)
+		except Full:
+			# Not checked yet, so a later read of the same nonce mustn't be dropped.
+			self.dedup.discard(gold.job, gold.nonce)
+			raise
+
+		depth = self.noncequeue.qsize()
+		with self.stats_lock:
+			self.max_depth = max(self.max_depth, depth)
+
+		return True
+	
+	def depth(self):
+		return self.noncequeue.qsize()
+	
+	def averageLatency(self):
+		with self.stats_lock:
+			if self.checked == 0:
+				return 0.0
+			return self.total_latency / self.checked
+	
+	def _dispatchLoop(self):
+		while True:
+			# Take whatever has piled up, but don't wait for more.
+			batch = [self.noncequeue.get(block=True)]
+			while len(batch) < BATCH_SIZE and not self.noncequeue.empty():
+				batch.append(self.noncequeue.get(False))
+
+			if self.pool is None:
+				self._report(batch, [gold.job.header.check(gold.nonce) for gold in batch])
+				continue
+
+			chunksize = -(-len(batch) // self.processes)
+			result = self.pool.map_async(_checkNonce, [(gold.job.header, gold.nonce) for gold in batch], chunksize)
+			# Blocks once enough batches are in flight.
+			self.inflight.put((batch, result))
+	
+	def _collectLoop(self):
+		while True:
+			(batch, result) = self.inflight.get(block=True)
+			try:
+				results = result.get()
+			except Exception, e:
+				self.logger.log("ERROR: Checking %d nonces failed (%s)! Lost them!" % (len(batch), e))
+				continue
+			self._report(batch, results)
+	
+	def _report(self, batch, results):
+		now = time.time()
+
+		for (gold, (valid, share)) in zip(batch, results):
+			latency = now - gold.found_time
+			with self.stats_lock:
+				self.checked += 1
+				self.total_latency += latency
+				self.max_latency = max(self.max_latency, latency)
+
+			if valid:
+				self.logger.reportValid(gold.fpgaID)
+			else:
+				self.logger.reportError(hex(gold.nonce)[2:], gold.fpgaID)
+				continue
+
+			if share:
+				try:
+					self.goldqueue.put(gold, block=True, timeout=10)
+					#logger.reportDebug("%d: goldqueue loaded (%d)" % (chain, goldqueue[chain].qsize()))
+				except Full:
+					self.logger.log("%d: Golden nonce queue full! Lost a golden nonce!" % gold.fpgaID)
@@ -0,0 +1,111 @@
+# Copyright (C) 2011-2012 by fizzisist <fizzisist@fpgamining.com>
+#                            fpgaminer <fpgaminer@bitcoin-mining.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+# Decides when each FPGA's nonce FIFO should be polled.
+#
+# Every golden nonce is a difficulty 1 share, so an FPGA hashing at H hashes
+# per second finds one every 2**32 / H seconds on average. Each FPGA is polled
+# a fixed number of times per expected nonce, on its own deadline with a
+# little jitter, so fast FPGAs are polled often and slow ones don't waste USB
+# bandwidth. If an FPGA's FIFO keeps coming back empty for much longer than
+# expected, its polls are backed off further.
+
+import random
+import time
+
+# Polls per expected nonce.
+POLLS_PER_NONCE = 32
+# Limits on the interval between two polls of the same FPGA, in seconds.
+MIN_POLL_INTERVAL = 0.02
+MAX_POLL_INTERVAL = 1.0
+# Random variation of each interval, as a fraction of it.
+POLL_JITTER = 0.1
+# Backoff applied per poll once the FIFO has been empty for more than
+# BACKOFF_AFTER expected nonce intervals, up to MAX_BACKOFF times the base interval.
+BACKOFF_AFTER = 2
+BACKOFF_FACTOR = 1.25
+MAX_BACKOFF = 4.0
+# Measured hashrate is trusted once this many valid nonces have been seen.
+MIN_VALIDS = 8
+# Hashrate assumed when nothing better is known (e.g. rev 0 firmware).
+DEFAULT_HASHRATE = 200e6
+
+
+class PollScheduler:
+	def __init__(self, fpga_list):
+		self.fpga_list = fpga_list
+		self.start_time = time.time()
+		self.start_valids = {}
+		self.deadlines = {}
+		self.empty_streak = {}
+		self.backoff = {}
+
+		for fpga in fpga_list:
+			self.start_valids[fpga.id] = fpga.valid_count
+			self.deadlines[fpga.id] = self.start_time
+			self.empty_streak[fpga.id] = 0
+			self.backoff[fpga.id] = 1.0
+	
+	def hashrate(self, fpga):
+		"""Best estimate of the FPGA's hashrate, in hashes per second."""
+		valids = fpga.valid_count - self.start_valids[fpga.id]
+		elapsed = time.time() - self.start_time
+
+		if valids >= MIN_VALIDS and elapsed > 0:
+			return valids * 2**32 / elapsed
+		if fpga.clock_speed:
+			return fpga.clock_speed * 1e6
+		return DEFAULT_HASHRATE
+	
+	def interval(self, fpga):
+		"""Interval until the FPGA's next poll, before jitter."""
+		nonce_interval = 2**32 / self.hashrate(fpga)
+		interval = nonce_interval / POLLS_PER_NONCE * self.backoff[fpga.id]
+		return max(MIN_POLL_INTERVAL, min(MAX_POLL_INTERVAL, interval))
+	
+	def due(self, fpga, now=None):
+		if now is None:
+			now = time.time()
+		return now >= self.deadlines[fpga.id]
+	
+	def nextDeadline(self):
+		return min(self.deadlines.values())
+	
+	def polled(self, fpga, found, start_time, now=None):
+		"""Record a poll that began at start_time and found found nonces, and schedule the next one."""
+		if now is None:
+			now = time.time()
+
+		fpga.poll_count += 1
+		fpga.poll_latency += now - min(start_time, self.deadlines[fpga.id])
+
+		if found > 0:
+			self.empty_streak[fpga.id] = 0
+			self.backoff[fpga.id] = 1.0
+		else:
+			fpga.empty_polls += 1
+			self.empty_streak[fpga.id] += 1
+			if self.empty_streak[fpga.id] > BACKOFF_AFTER * POLLS_PER_NONCE:
+				self.backoff[fpga.id] = min(MAX_BACKOFF, self.backoff[fpga.id] * BACKOFF_FACTOR)
+
+		jitter = 1 + random.uniform(-POLL_JITTER, POLL_JITTER)
+		self.deadlines[fpga.id] = now + self.interval(fpga) * jitter
@@ -0,0 +1,131 @@
+# Copyright (C) 2011-2012 by fizzisist <fizzisist@fpgamining.com>
+#                            fpgaminer <fpgaminer@bitcoin-mining.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+# Keeps FPGAs within safe temperatures.
+#
+# The board has a temperature sensor next to each FPGA. They are sampled
+# periodically, and an FPGA's clock is stepped down on every sample it spends
+# above the soft limit. Above the hard limit it is put to sleep until it has
+# cooled down again. Once below the soft limit (minus some hysteresis), the
+# clock is stepped back up to where it was before throttling began.
+
+import time
+
+# Throttle states
+THROTTLED = 'throttled'
+SUSPENDED = 'suspended'
+
+DEFAULT_SOFT_LIMIT = 65
+DEFAULT_HARD_LIMIT = 75
+# How far below a limit an FPGA must cool before throttling is eased, in degrees C.
+HYSTERESIS = 5
+# Seconds between temperature samples.
+SAMPLE_INTERVAL = 10
+# Clock change per sample while throttling or recovering, in MHz.
+THROTTLE_STEP = 10
+# Throttling never takes the clock below this, in MHz.
+MIN_CLOCK = 50
+
+
+class ThermalMonitor:
+	def __init__(self, ft232r, fpga_list, logger, soft_limit=DEFAULT_SOFT_LIMIT, hard_limit=DEFAULT_HARD_LIMIT):
+		self.ft232r = ft232r
+		self.fpga_list = fpga_list
+		self.logger = logger
+		self.soft_limit = soft_limit
+		self.hard_limit = hard_limit
+		self.last_sample = 0
+		# Clock each throttled FPGA was running at before throttling began
+		self.restore_clocks = {}
+	
+	def update(self):
+		"""Sample the temperatures if it is time to, and throttle FPGAs accordingly."""
+		now = time.time()
+		if now - self.last_sample < SAMPLE_INTERVAL:
+			return
+		self.last_sample = now
+
+		try:
+			temps = self.ft232r.read_temps()
+		except Exception, e:
+			self.logger.log("WARNING: Could not read temperatures (%s), thermal throttling disabled" % e, False)
+			self.last_sample = float('inf')
+			return
+
+		for fpga in self.fpga_list:
+			fpga.temperature = temps[fpga.chain]
+			if fpga.temperature is not None:
+				self._control(fpga, fpga.temperature)
+	
+	def _control(self, fpga, temp):
+		if temp >= self.hard_limit and fpga.throttle != SUSPENDED:
+			self.logger.log("FPGA %d: %.1fC is over the hard limit, suspending" % (fpga.id, temp))
+			self._saveClock(fpga)
+			fpga.throttle = SUSPENDED
+
+		if fpga.throttle == SUSPENDED:
+			if temp > self.hard_limit - HYSTERESIS:
+				# The mining thread may have woken it just before it was suspended.
+				with self.ft232r.lock:
+					if not fpga.asleep:
+						fpga.sleep()
+				return
+			self.logger.log("FPGA %d: Cooled to %.1fC, resuming" % (fpga.id, temp))
+			with self.ft232r.lock:
+				fpga.wake()
+				fpga.throttle = THROTTLED
+			# Come back at a reduced clock; it is raised again once below the soft limit.
+			self._stepClock(fpga, -THROTTLE_STEP)
+			return
+
+		if temp >= self.soft_limit:
+			if fpga.throttle is None:
+				self.logger.log("FPGA %d: %.1fC is over the soft limit, throttling" % (fpga.id, temp))
+				self._saveClock(fpga)
+				fpga.throttle = THROTTLED
+			self._stepClock(fpga, -THROTTLE_STEP)
+		elif fpga.throttle == THROTTLED and temp <= self.soft_limit - HYSTERESIS:
+			self._stepClock(fpga, THROTTLE_STEP)
+	
+	def _saveClock(self, fpga):
+		if fpga.id not in self.restore_clocks:
+			self.restore_clocks[fpga.id] = fpga.clock_speed
+	
+	def _stepClock(self, fpga, step):
+		restore = self.restore_clocks.get(fpga.id)
+
+		# Old firmware has no clock register, so all we can do is wait.
+		if restore is None:
+			if step > 0:
+				self._restored(fpga)
+			return
+
+		clock = max(MIN_CLOCK, min(restore, fpga.clock_speed + step))
+		if clock != fpga.clock_speed:
+			fpga.setClockSpeed(clock)
+		if step > 0 and clock >= restore:
+			self._restored(fpga)
+	
+	def _restored(self, fpga):
+		self.logger.log("FPGA %d: Back to normal at %.1fC" % (fpga.id, fpga.temperature))
+		del self.restore_clocks[fpga.id]
+		fpga.throttle = None
@@ -20,11 +20,42 @@
 # THE SOFTWARE.
 
 from Queue import Queue, Empty, Full
-from jtag import JTAG
+from threading import RLock
+from jtag import JTAG, JTAGSequence
+from TAP import TAP
+from NonceCheck import JobHeader
 import time
+import math
 
-class Object(object):
-	pass
+class Job(object):
+	"""A unit of work for the FPGA.
+	Everything the FPGA needs is decoded once, when the job is queued, so that
+	loading it only has to append a precompiled stream while holding the lock.
+	"""
+	__slots__ = ('midstate', 'data', 'target', 'words', 'stream', 'header')
+
+	def __init__(self, work):
+		self.midstate = work['midstate']
+		self.data = work['data']
+		self.target = work['target']
+
+		# We need the 256-bit midstate, and 12 bytes from data.
+		# The first 64 bytes of data are already hashed (hence midstate),
+		# so we skip that. Of the last 64 bytes, 52 bytes are constant and
+		# not needed by the FPGA.
+		data = hexstr2array(self.midstate) + hexstr2array(self.data)[64:64+12]
+
+		self.words = []
+
+		for i in range(11):
+			word = data[i*4] | (data[i*4+1] << 8) | (data[i*4+2] << 16) | (data[i*4+3] << 24)
+			self.words.append(word)
+
+		# Precompiled DR scans for the job words, set by FPGA.putJob
+		self.stream = None
+
+		# For checking the nonces found for this job
+		self.header = JobHeader(self.data, self.target)
 
 # JTAG instructions:
 USER_INSTRUCTION = 0b000010
@@ -36,6 +67,16 @@ CFG_OUT          = 0b000100
 BYPASS           = 0b111111
 USERCODE	 = 0b001000
 
+# Most nonces read from the FIFO in one JTAG transaction.
+MAX_NONCE_BATCH = 8
+# Weight of the newest poll in the moving average of nonces found per poll.
+NONCE_RATE_WEIGHT = 0.25
+# How many times a verified burst write is retried after a readback mismatch.
+VERIFY_RETRIES = 2
+# Byte slots of the old (rev 0) firmware's FIFO read per JTAG transaction.
+# A nonce takes four.
+OLD_READ_SLOTS = 8
+
 
 def hexstr2array(hexstr):
 	"""Convert a hex string into an array of bytes"""
@@ -73,6 +114,14 @@ class FPGA:
 		self.ft232r = ft232r
 		self.chain = chain
 		self.jtag = JTAG(ft232r, chain)
+		self.compiler = None
+		self.templates = {}
+		self.template_config = None
+		# Jobs are compiled on the RPC thread while workers use the same
+		# templates; this guards compiler, templates and template_config.
+		self.template_lock = RLock()
+		# Nonces read by _old_readNonces beyond what the caller wanted.
+		self.old_nonces = []
 		self.logger = logger
 		self.id = -1
 		
@@ -85,6 +134,34 @@ class FPGA:
 		self.accepted_count = 0
 		self.rejected_count = 0
 		self.recent_valids = 0
+		self.duplicate_count = 0
+		
+		self.poll_count = 0
+		self.empty_polls = 0
+		self.poll_latency = 0.0
+		
+		# Last clock speed read from or written to the FPGA, in MHz
+		self.clock_speed = None
+		
+		# When the current job was loaded, and how long the FPGA has spent
+		# hashing jobs it had already searched completely.
+		self.job_start = None
+		self.wasted_time = 0.0
+		
+		# Latest reading of the temperature sensor next to this FPGA, in degrees C
+		self.temperature = None
+		# None, or the ThermalMonitor state this FPGA is in
+		self.throttle = None
+		
+		# How many nonces to read per poll, sized from the recent nonce rate.
+		self.nonce_batch = 1
+		self.nonce_rate = 0.0
+		
+		# Read back the last register of every burst write to check it arrived.
+		# Needs firmware that can read back the registers being written.
+		self.verify_writes = False
+		self.verified_writes = 0
+		self.failed_verifies = 0
 		
 		self.asleep = True
 
@@ -135,20 +212,8 @@ class FPGA:
 
 		with self.ft232r.lock:
 			if self.asleep: self.wake()
-			self.jtag.tap.reset()
-			self.jtag.instruction(USER_INSTRUCTION)
-			self.jtag.shift_ir()
-
-			# Tell the FPGA what address we would like to read
-			data = int2bits(address, 5)
-			data = data + jtagcomm_checksum(data)
-			self.jtag.shift_dr(data)
-
-			# Now read back the register
-			data = self.jtag.read_dr(int2bits(0, 32))
-			data = bits2int(data)
-
-			self.jtag.tap.reset()
+			self.jtag.replay(self._readTemplate(address))
+			data = bits2int(self.jtag.read_deferred()[0])
 
 		return data
 
@@ -158,137 +223,287 @@ class FPGA:
 		address = address & 0xF
 		data = data & 0xFFFFFFFF
 
+		# Tell the FPGA what address we would like to write
+		# and the data.
+		data = int2bits(data, 32) + int2bits(address, 4) + [1]
+		data = data + jtagcomm_checksum(data)
+
 		with self.ft232r.lock:
 			if self.asleep: self.wake()
-			self.jtag.tap.reset()
-			self.jtag.instruction(USER_INSTRUCTION)
-			self.jtag.shift_ir()
+			(template, offset) = self._writeTemplate(address)
+			# Only the data bits and the checksum differ from the template.
+			self.jtag.replay(self._patchTemplate(template, offset, data, range(32) + [len(data)-1]))
+			self.ft232r.flush()
+	
+	# Compiled JTAG sequences for the common register operations are cached
+	# per operation and address. The cache is thrown away whenever the chain's
+	# pin mapping, IR lengths or active part change. Each template is checked
+	# against running its sequence on the chain itself when it is compiled;
+	# build, if given, then turns it into whatever is cached.
+	def _chainConfig(self):
+		return (tuple(sorted(vars(self.jtag.portlist).items())),
+		        tuple(self.jtag.irlengths or []), self.jtag.current_part)
+	
+	# Throw away the templates and compiler if the chain's configuration has
+	# changed, and return the current one. Call with template_lock held.
+	def _checkConfig(self):
+		config = self._chainConfig()
+		if config != self.template_config:
+			self.templates = {}
+			self.compiler = None
+			self.template_config = config
+		return config
+	
+	def _template(self, key, sequence, build=None):
+		with self.template_lock:
+			config = self._checkConfig()
+			template = self.templates.get(key)
+			if template is not None:
+				return template
+			compiled = self._compile(sequence)
+
+		# Callers may hold the device lock, which checkCompiled takes, so it
+		# is run without template_lock to keep the two from deadlocking.
+		self.jtag.checkCompiled(sequence, compiled)
+		template = compiled if build is None else build(compiled)
+
+		with self.template_lock:
+			if self.template_config == config:
+				self.templates[key] = template
+		return template
+	
+	def _compile(self, sequence, state=TAP.IDLE):
+		with self.template_lock:
+			self._checkConfig()
+			if self.compiler is None:
+				self.compiler = self.jtag.compiler()
+			return self.compiler.compile(sequence, state)
+	
+	# Reset, load USER_INSTRUCTION, then read register address count times.
+	# If close is False the TAP is left in IDLE, so more can be queued.
+	def _readTemplate(self, address, count=1, close=True):
+		def sequence(jtag):
+			jtag.tap.reset()
+			jtag.instruction(USER_INSTRUCTION)
+			jtag.shift_ir()
+			for i in range(count):
+				self._queueRegisterRead(address, jtag)
+			if close:
+				jtag.tap.reset()
 
-			# Tell the FPGA what address we would like to write
-			# and the data.
-			data = int2bits(data, 32) + int2bits(address, 4) + [1]
-			data = data + jtagcomm_checksum(data)
-			self.jtag.shift_dr(data)
+		return self._template(('read', address, count, close), sequence)
+	
+	# Queue a register read; the result comes from read_deferred.
+	def _queueRegisterRead(self, address, jtag):
+		# Tell the FPGA what address we would like to read
+		data = int2bits(address, 5)
+		data = data + jtagcomm_checksum(data)
+		jtag.shift_dr(data)
+
+		# Now read back the register
+		jtag.shift_dr(int2bits(0, 32), defer=True)
+	
+	# A register write with all-zero data, and the offset of its DR scan.
+	def _writeTemplate(self, address):
+		def sequence(jtag):
+			jtag.tap.reset()
+			jtag.instruction(USER_INSTRUCTION)
+			jtag.shift_ir()
+			# Deferring the scan records where it starts; nothing is read back.
+			data = int2bits(0, 32) + int2bits(address, 4) + [1]
+			jtag.shift_dr(data + jtagcomm_checksum(data), defer=True)
+			jtag.tap.reset()
 
-			self.jtag.tap.reset()
-			self.ft232r.flush()
+		def build(compiled):
+			return (JTAGSequence(compiled.data, [], compiled.state), compiled.reads[0][0])
+
+		return self._template(('write', address), sequence, build)
 	
-	def _burstWriteHelper(self, address, data):
+	# Copy a template, changing the TDI value of the given bits of the DR scan at offset.
+	def _patchTemplate(self, template, offset, bits, indexes):
+		mask = ord(self.jtag.portlist.format(0, 0, 1))
+		data = bytearray(template.data)
+
+		for i in indexes:
+			# Each clock is three bytes in the write buffer
+			for position in range(offset + i*3, offset + i*3 + 3):
+				if bits[i]:
+					data[position] |= mask
+				else:
+					data[position] &= ~mask
+
+		return JTAGSequence(str(data), [], template.state)
+	
+	def _burstWriteHelper(self, address, data, jtag=None):
 		address = address & 0xF
 		x = int2bits(data, 32)
 		x += int2bits(address, 4)
 		x += [1]
 		x = x + jtagcomm_checksum(x)
 
-		self.jtag.shift_dr(x)
+		(jtag or self.jtag).shift_dr(x)
+	
+	# Compile the DR scans of a burst write into a JTAGSequence, which
+	# _burstWrite can then replay without re-encoding.
+	def _compileBurstWrite(self, address, data):
+		def sequence(jtag):
+			for offset in range(len(data)):
+				self._burstWriteHelper(address + offset, data[offset], jtag)
+
+		return self._compile(sequence)
 
 	
 	# Writes multiple 32-bit registers.
 	# data should be an array of 32-bit values
 	# address is the starting address.
-	# TODO: Implement readback of some kind to ensure all our writes succeeded.
-	# TODO: This is difficult, because reading back data will slow things down.
-	# TODO: If the JTAG class let us read data back after a shift, we could probably
-	# TODO: use that at the end of the burst write.
-	def _burstWrite(self, address, data):
+	# stream may be the same write precompiled by _compileBurstWrite.
+	# If verify_writes is set, the last register is read back as part of the
+	# same transaction, and the write retried on a mismatch. Returns False
+	# if it still failed after VERIFY_RETRIES retries.
+	def _burstWrite(self, address, data, stream=None):
 		with self.ft232r.lock:
-			if self.asleep: self.wake()
-			self.jtag.tap.reset()
-			self.jtag.instruction(USER_INSTRUCTION)
-			self.jtag.shift_ir()
+			for attempt in range(VERIFY_RETRIES + 1):
+				if self.asleep: self.wake()
+				self.jtag.tap.reset()
+				self.jtag.instruction(USER_INSTRUCTION)
+				self.jtag.shift_ir()
+
+				if stream is not None:
+					self.jtag.replay(stream)
+				else:
+					for offset in range(len(data)):
+						self._burstWriteHelper(address + offset, data[offset])
 
-			for offset in range(len(data)):
-				self._burstWriteHelper(address + offset, data[offset])
+				if not self.verify_writes:
+					self.jtag.tap.reset()
+					self.ft232r.flush()
+					return True
 
-			self.jtag.tap.reset()
-			self.ft232r.flush()
+				self._queueRegisterRead(address + len(data) - 1, self.jtag)
+				readback = self.jtag.read_deferred()[-1]
+				self.jtag.tap.reset()
 
-		return True
+				if self._checkReadback(readback, data[-1]):
+					return True
+
+		return False
+	
+	def _checkReadback(self, readback, expected):
+		if bits2int(readback) == expected & 0xFFFFFFFF:
+			self.verified_writes += 1
+			return True
+
+		self.failed_verifies += 1
+		self.logger.reportDebug("%d: Readback mismatch: wrote %08x, read %08x" % (self.id, expected & 0xFFFFFFFF, bits2int(readback)))
+		return False
 	
 	# TODO: Remove backwards compatibility in a future rev.
 	def _old_readNonce(self):
+		if len(self.old_nonces) == 0:
+			self.old_nonces = self._old_readNonces(1)
+		if len(self.old_nonces) == 0:
+			return None
+		return self.old_nonces.pop(0)
+	
+	# The old firmware's FIFO is read a byte at a time, each byte in its own DR
+	# scan. Rather than a USB round trip per byte, OLD_READ_SLOTS bytes are read
+	# speculatively in one transaction and synced to nonces in software. Reading
+	# an empty FIFO is harmless, so this only ever costs a few extra clocks.
+	# Reset and select USER_INSTRUCTION, which starts every rev 0 transaction.
+	def _oldSelectTemplate(self):
+		def sequence(jtag):
+			jtag.tap.reset()
+			jtag.instruction(USER_INSTRUCTION)
+			jtag.shift_ir()
+
+		return self._template(('old_select',), sequence)
+	
+	def _oldReadTemplate(self, start):
+		def sequence(jtag):
+			if start:
+				jtag.tap.reset()
+				jtag.instruction(USER_INSTRUCTION)
+				jtag.shift_ir()
+			for i in range(OLD_READ_SLOTS):
+				jtag.shift_dr(int2bits(0, 13), defer=True)
+
+		return self._template(('old_read', start), sequence)
+	
+	# Read the next OLD_READ_SLOTS bytes from the FIFO. Pass start=True for the
+	# first read of a transaction, to select USER_INSTRUCTION. The TAP is left in IDLE.
+	def _oldReadSlots(self, start):
+		self.jtag.replay(self._oldReadTemplate(start))
+		return map(bits2int, self.jtag.read_deferred())
+	
+	# Read at least count nonces, if there are that many, or until the FIFO is empty.
+	def _old_readNonces(self, count=MAX_NONCE_BATCH):
+		nonces = self.old_nonces
+		self.old_nonces = []
+		nonce = None
+		start = True
+
 		with self.ft232r.lock:
 			if self.asleep: self.wake()
-			self.jtag.tap.reset()
-			self.jtag.instruction(USER_INSTRUCTION)
-			self.jtag.shift_ir()
-			self.asleep = False
 
-			# Sync to the beginning of a nonce.
-			# The MSB is a VALID flag. If 0, data is invalid (queue empty).
-			# The next 4-bits indicate which byte of the nonce we got.
-			# 1111 is LSB, and then 0111, 0011, 0001.
-			byte = None
 			while True:
-				byte = self._readByte()
-
-				# check data valid bit:
-				if byte < 0x1000:
-					self.jtag.tap.reset()
-					return None
-				
-				#self.logger.reportDebug("%d: Read: %04x" % (self.id, byte))
-				
-				# check byte counter:
-				if (byte & 0xF00) == 0xF00:
-					break
-			
-			# We now have the first byte
-			nonce = byte & 0xFF
-			count = 1
-			#self.logger.reportDebug("%d: Potential nonce, reading the rest..." % self.id)
-			while True:
-				byte = self._readByte()
-				
-				#self.logger.reportDebug("%d: Read: %04x" % (self.id, byte))
-				
-				# check data valid bit:
-				if byte < 0x1000:
-					self.jtag.tap.reset()
-					return None
-				
-				# check byte counter:
-				if (byte & 0xF00) >> 8 != (0xF >> count):
-					self.jtag.tap.reset()
-					return None
-				
-				nonce |= (byte & 0xFF) << (count * 8)
-				count += 1
-				
-				if (byte & 0xF00) == 0x100:
+				empty = False
+
+				for byte in self._oldReadSlots(start):
+					# The MSB is a VALID flag. If 0, data is invalid (queue empty).
+					if byte < 0x1000:
+						empty = True
+						break
+
+					# The next 4-bits indicate which byte of the nonce we got.
+					# 1111 is LSB, and then 0111, 0011, 0001.
+					counter = (byte & 0xF00) >> 8
+					if counter == 0xF:
+						nonce = byte & 0xFF
+						got = 1
+					elif nonce is not None and counter == (0xF >> got):
+						nonce |= (byte & 0xFF) << (got * 8)
+						got += 1
+						if got == 4:
+							nonces.append(nonce)
+							nonce = None
+					else:
+						# Out of sync; skip to the start of the next nonce.
+						nonce = None
+
+				start = False
+
+				# Never stop part way through a nonce; its first bytes are already gone.
+				if empty or (len(nonces) >= count and nonce is None):
 					break
 
 			self.jtag.tap.reset()
 
-		#self.logger.reportDebug("%d: Nonce completely read: %08x" % (self.id, nonce))
+		#self.logger.reportDebug("%d: Read %d nonces" % (self.id, len(nonces)))
 
-		return nonce
+		return nonces
 	
 	# TODO: This may not actually clear the queue, but should be correct most of the time.
 	def _old_clearQueue(self):
 		with self.ft232r.lock:
 			if self.asleep: self.wake()
-			self.jtag.tap.reset()
-			self.jtag.instruction(USER_INSTRUCTION)
-			self.jtag.shift_ir()
-			self.asleep = False
 			
 			self.logger.reportDebug("%d: Clearing queue..." % self.id)
+			start = True
 			while True:
-				if self._readByte() < 0x1000:
+				if min(self._oldReadSlots(start)) < 0x1000:
 					break
+				start = False
 			self.jtag.tap.reset()
+			self.old_nonces = []
 		
 		self.logger.reportDebug("%d: Queue cleared" % self.id)
 	
-	def _old_writeJob(self, job):
+	# Compile the whole job load for the old firmware into a JTAGSequence.
+	def _compileOldWriteJob(self, job):
 		# We need the 256-bit midstate, and 12 bytes from data.
 		# The first 64 bytes of data are already hashed (hence midstate),
 		# so we skip that. Of the last 64 bytes, 52 bytes are constant and
 		# not needed by the FPGA.
-		
-		start_time = time.time()
-		
 		midstate = hexstr2array(job.midstate)
 		data = hexstr2array(job.data)[64:64+12]
 
@@ -296,26 +511,37 @@ class FPGA:
 		midstate.reverse()
 		data.reverse()
 
-		with self.ft232r.lock:
-			#self.logger.reportDebug("%d: Loading job data..." % self.id)
-			
-			if self.asleep: self.wake()
-			self.jtag.tap.reset()
-			self.jtag.instruction(USER_INSTRUCTION)
-			self.jtag.shift_ir()
+		data = midstate + data + [0]
 
-			data = midstate + data + [0]
+		# The IR scan is the same for every job, and comes from a checked template.
+		select = self._oldSelectTemplate()
 
+		def sequence(jtag):
 			for i in range(len(data)):
 				x = data[i]
 
 				if i != 0:
 					x = 0x100 | x
 					
-				self.jtag.shift_dr(int2bits(x, 13))
+				jtag.shift_dr(int2bits(x, 13))
 			
-			self.jtag.tap.reset()
+			jtag.tap.reset()
+
+		compiled = self._compile(sequence, select.state)
+		return JTAGSequence(select.data + compiled.data, [], compiled.state)
+	
+	def _old_writeJob(self, job):
+		start_time = time.time()
+
+		stream = job.stream
+		if stream is None:
+			stream = self._compileOldWriteJob(job)
 
+		with self.ft232r.lock:
+			#self.logger.reportDebug("%d: Loading job data..." % self.id)
+			
+			if self.asleep: self.wake()
+			self.jtag.replay(stream)
 			self.ft232r.flush()
 		
 		#self.logger.reportDebug("%d: Job data loaded in %.3f seconds" % (self.id, time.time() - start_time))
@@ -328,39 +554,89 @@ class FPGA:
 			return None
 		return nonce
 	
+	# Read up to count nonces from the FIFO in a single JTAG transaction.
+	# If count is None, it is sized from the recent nonce rate.
+	def _readNonces(self, count=None):
+		adaptive = count is None
+		if adaptive:
+			count = self.nonce_batch
+
+		with self.ft232r.lock:
+			if self.asleep: self.wake()
+			self.jtag.replay(self._readTemplate(0xE, count))
+			results = self.jtag.read_deferred()
+
+		nonces = [nonce for nonce in map(bits2int, results) if nonce != 0xFFFFFFFF]
+
+		if adaptive:
+			self._updateNonceBatch(len(nonces), count)
+
+		return nonces
+	
+	def _updateNonceBatch(self, found, requested):
+		self.nonce_rate += NONCE_RATE_WEIGHT * (found - self.nonce_rate)
+
+		if found == requested:
+			# The FIFO may hold more than we asked for.
+			batch = requested * 2
+		else:
+			batch = int(math.ceil(2 * self.nonce_rate))
+
+		self.nonce_batch = max(1, min(MAX_NONCE_BATCH, batch))
+	
 	def _clearQueue(self):
 		self.logger.reportDebug("%d: Clearing queue..." % self.id)
 		while True:
-			if self.readNonce() is None:
+			if len(self._readNonces(MAX_NONCE_BATCH)) < MAX_NONCE_BATCH:
 				break
 		
 		self.logger.reportDebug("%d: Queue cleared" % self.id)
 	
 	def _writeJob(self, job):
-		# We need the 256-bit midstate, and 12 bytes from data.
-		# The first 64 bytes of data are already hashed (hence midstate),
-		# so we skip that. Of the last 64 bytes, 52 bytes are constant and
-		# not needed by the FPGA.
-		
 		start_time = time.time()
-		
-		midstate = hexstr2array(job.midstate)
-		data = hexstr2array(job.data)[64:64+12]
-		data = midstate + data
-
-		words = []
-
-		for i in range(11):
-			word = data[i*4] | (data[i*4+1] << 8) | (data[i*4+2] << 16) | (data[i*4+3] << 24)
-			words.append(word)
 
-		if not self._burstWrite(1, words):
+		if not self._burstWrite(1, job.words, job.stream):
 			self.logger.reportDebug("%d: ERROR: Loading job data failed; readback failure" % self.id)
 			return
 		
 		self.logger.reportDebug("%d: Job data loaded in %.3f seconds" % (self.id, time.time() - start_time))
 		#self.logger.reportDebug("%d: Job data loaded" % self.id)
 	
+	# Read the outstanding nonces and load a new job in one JTAG transaction.
+	# The job words are clocked out synchronously as part of the nonce readback,
+	# so by the time this returns the FPGA has received the whole job.
+	def _switchJob(self, job):
+		start_time = time.time()
+		
+		count = self.nonce_batch
+
+		with self.ft232r.lock:
+			if self.asleep: self.wake()
+			self.jtag.replay(self._readTemplate(0xE, count, close=False))
+
+			if job.stream is not None:
+				self.jtag.replay(job.stream)
+			else:
+				for offset in range(len(job.words)):
+					self._burstWriteHelper(1 + offset, job.words[offset])
+
+			if self.verify_writes:
+				self._queueRegisterRead(len(job.words), self.jtag)
+
+			results = self.jtag.read_deferred()
+			self.jtag.tap.reset()
+
+			if self.verify_writes and not self._checkReadback(results.pop(), job.words[-1]):
+				# Still holding the lock, so nothing can sneak in before the retry.
+				if not self._burstWrite(1, job.words, job.stream):
+					self.logger.reportDebug("%d: ERROR: Loading job data failed; readback failure" % self.id)
+
+		nonces = [nonce for nonce in map(bits2int, results) if nonce != 0xFFFFFFFF]
+		self._updateNonceBatch(len(nonces), count)
+
+		self.logger.reportDebug("%d: Job switched in %.3f seconds" % (self.id, time.time() - start_time))
+		return nonces
+	
 	# Read the FPGA's current clock speed, in MHz
 	# NOTE: This is currently just what we've written into the clock speed
 	# register, so it does NOT take into account hard limits in the firmware.
@@ -369,6 +645,7 @@ class FPGA:
 			return None
 		
 		frequency = self._readRegister(0xD)
+		self.clock_speed = frequency
 
 		return frequency
 
@@ -378,6 +655,7 @@ class FPGA:
 		if self.firmware_rev == 0:
 			return False
 
+		self.clock_speed = speed
 		return self._writeRegister(0xD, speed)
 	
 	def readNonce(self):
@@ -386,6 +664,13 @@ class FPGA:
 		else:
 			return self._readNonce()
 	
+	# Read every nonce currently waiting in the FIFO, as a list.
+	def readNonces(self):
+		if self.firmware_rev == 0:
+			return self._old_readNonces()
+		else:
+			return self._readNonces()
+	
 	def clearQueue(self):
 		if self.firmware_rev == 0:
 			return self._old_clearQueue()
@@ -398,18 +683,46 @@ class FPGA:
 		else:
 			return self._writeJob(job)
 	
-	def getJob(self):
+	# Load a new job, returning any nonces the FPGA found for the previous one.
+	def switchJob(self, job):
+		if self.firmware_rev == 0:
+			nonces = self.readNonces()
+			self.writeJob(job)
+		else:
+			nonces = self._switchJob(job)
+
+		now = time.time()
+		exhaust_time = self.nonceSpaceTime()
+		if self.job_start is not None and exhaust_time is not None:
+			self.wasted_time += max(0, now - self.job_start - exhaust_time)
+		self.job_start = now
+
+		return nonces
+	
+	# How long the FPGA takes to search a job's whole 2^32 nonce range, in
+	# seconds, or None if its clock speed is unknown. It hashes once per clock.
+	def nonceSpaceTime(self):
+		if not self.clock_speed:
+			return None
+		return 2**32 / (self.clock_speed * 1e6)
+	
+	# Take the next job off the queue, waiting up to timeout seconds for one
+	# if a timeout is given. Returns None if there is none.
+	def getJob(self, timeout=None):
 		try:
 			#logger.reportDebug("%d: Checking for new job..." % fpga.id)
-			return self.jobqueue.get(False)
+			if timeout is None:
+				return self.jobqueue.get(False)
+			return self.jobqueue.get(True, timeout)
 		except Empty:
 			return None
 	
 	def putJob(self, work):
-		job = Object()
-		job.midstate = work['midstate']
-		job.data = work['data']
-		job.target = work['target']
+		job = Job(work)
+		if self.firmware_rev == 0:
+			job.stream = self._compileOldWriteJob(job)
+		else:
+			job.stream = self._compileBurstWrite(1, job.words)
 		self.jobqueue.put(job)
 		#self.logger.reportDebug("%d: jobqueue loaded (%d)" % (fpga.id, self.jobqueue.qsize()))
 	
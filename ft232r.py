@@ -291,7 +291,21 @@ class FT232R:
 		self._log("Read %d bytes." % len(data), 3)
 		return data
 
+	# Read the temperature sensors next to both FPGAs, in degrees C (None if a
+	# sensor is missing). This switches the FT232R into CBUS bit-bang mode, so it
+	# flushes any pending JTAG data first and restores Synchronous mode afterwards.
 	def read_temps(self):
+		with self.lock:
+			if len(self.write_buffer) > 0:
+				self.flush()
+			
+			try:
+				return self._read_temps()
+			finally:
+				self._setSyncMode()
+				self._purgeBuffers()
+	
+	def _read_temps(self):
 		self._log("Reading temp sensors.")
 		
 		# clock SC with CS high:
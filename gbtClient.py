@@ -0,0 +1,404 @@
+# Copyright (C) 2011 by fpgaminer <fpgaminer@bitcoin-mining.com>
+#                       fizzisist <fizzisist@fpgamining.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+# Solo mining against bitcoind with getblocktemplate (BIP 22/23).
+#
+# bitcoind hands out a block template; everything else happens here. Each
+# unit of work gets its own extranonce in the coinbase transaction, from
+# which the merkle root, header and midstate are rebuilt. Templates are
+# refreshed every TEMPLATE_REFRESH seconds, and immediately when a long poll
+# reports a new block. A nonce that meets the block target is assembled into
+# a full block and sent with submitblock.
+#
+# Job scheduling is shared with RPCClient (getwork_loop and friends); only
+# where work comes from and where solutions go is different.
+
+import httplib
+import time
+from json import dumps
+from threading import Lock, Event
+from collections import OrderedDict
+from struct import pack
+from rpcClient import RPCClient, ConnectionPool, NotAuthorized, RPCError
+from BlockHeader import doubleSha, merkleRoot, merkleBranch, makeHeader, makeWork
+
+B58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+# Base58 address version bytes, for mainnet and testnet/regtest
+P2PKH_VERSIONS = (0x00, 0x6f)
+P2SH_VERSIONS = (0x05, 0xc4)
+
+def addressScript(address):
+	"""The output script paying to a base58 (P2PKH or P2SH) address."""
+	n = 0
+	for c in address:
+		if c not in B58_ALPHABET:
+			raise ValueError("Invalid character %r in address" % c)
+		n = n * 58 + B58_ALPHABET.index(c)
+
+	raw = '%x' % n
+	raw = ('0' * (len(raw) % 2) + raw).decode('hex')
+	raw = '\x00' * (len(address) - len(address.lstrip('1'))) + raw
+
+	if len(raw) != 25 or doubleSha(raw[:21])[:4] != raw[21:]:
+		raise ValueError("Invalid address %s" % address)
+
+	version = ord(raw[0])
+	if version in P2PKH_VERSIONS:
+		# OP_DUP OP_HASH160 <hash> OP_EQUALVERIFY OP_CHECKSIG
+		return '\x76\xa9\x14' + raw[1:21] + '\x88\xac'
+	if version in P2SH_VERSIONS:
+		# OP_HASH160 <hash> OP_EQUAL
+		return '\xa9\x14' + raw[1:21] + '\x87'
+	raise ValueError("Unsupported address version %d" % version)
+
+def varint(n):
+	if n < 0xfd:
+		return chr(n)
+	if n <= 0xffff:
+		return '\xfd' + pack('<H', n)
+	if n <= 0xffffffff:
+		return '\xfe' + pack('<I', n)
+	return '\xff' + pack('<Q', n)
+
+def heightScript(height):
+	"""The block height as BIP 34 wants it at the start of the coinbase script."""
+	if height == 0:
+		return '\x00'
+	if height <= 16:
+		# OP_1 to OP_16
+		return chr(0x50 + height)
+	data = ''
+	while height > 0:
+		data += chr(height & 0xff)
+		height >>= 8
+	if ord(data[-1]) & 0x80:
+		data += '\x00'
+	return chr(len(data)) + data
+
+
+class GBTClient(RPCClient):
+	
+	# Seconds a template is used for before fetching a new one, to pick up new transactions
+	TEMPLATE_REFRESH = 30
+	# Work units remembered so that solutions can be turned back into blocks
+	MAX_WORK_RECORDS = 1024
+	COINBASE_TAG = '/x6500-miner/'
+	# Work is built locally, so there is nothing to fetch ahead
+	PREFETCH_DEPTH = 0
+	# The coinbase is always built here, so ask for coinbasevalue rather than coinbasetxn.
+	GBT_REQUEST = {'rules': ['segwit'], 'capabilities': ['coinbasevalue', 'workid', 'longpoll']}
+	
+	def __init__(self, settings, logger, goldqueue):
+		RPCClient.__init__(self, settings, logger, goldqueue)
+		self.payout_script = addressScript(settings.coinbase_addr)
+		
+		self.template_lock = Lock()
+		self.template_ready = Event()
+		self.template = None
+		self.template_time = 0
+		self.branch = []
+		self.extranonce = 0
+		# (header, coinbase, template) for each work unit handed out, by the header it produced
+		self.works = OrderedDict()
+		self.lp_pool = ConnectionPool(lambda: self.connect(self.proto, self.host, self.long_poll_timeout), 1)
+	
+	# Make a JSON-RPC call on a connection from pool. Raises on failure.
+	def call(self, pool, method, params):
+		connection = pool.acquire()
+		try:
+			(connection, result) = self.request(connection, '/', self.headers, dumps({'method': method, 'params': params, 'id': 'json'}))[:2]
+		except NotAuthorized:
+			pool.release(connection, True)
+			self.failure('Wrong username or password.')
+		except RPCError:
+			pool.release(connection, True)
+			raise
+		except:
+			pool.release(connection, False)
+			raise
+		pool.release(connection, True)
+		return result['result']
+	
+	def setTemplate(self, template):
+		"""Start making work from template. Returns True if it is for a new block."""
+		if 'coinbasevalue' not in template:
+			raise RPCError("Block template has no coinbasevalue, so the coinbase can't be built")
+		txids = [(tx.get('txid') or tx['hash']).decode('hex')[::-1] for tx in template['transactions']]
+		branch = merkleBranch(txids)
+
+		with self.template_lock:
+			new_block = self.template is None or self.template['previousblockhash'] != template['previousblockhash']
+			self.template = template
+			self.template_time = time.time()
+			self.branch = branch
+		self.template_ready.set()
+
+		if new_block:
+			self.logger.reportBlock(template['height'])
+		return new_block
+	
+	def fetchTemplate(self):
+		try:
+			template = self.call(self.work_pool, 'getblocktemplate', [self.GBT_REQUEST])
+			self.setTemplate(template)
+			return True
+		except (RPCError, IOError, ValueError, KeyError, httplib.HTTPException) as e:
+			self.logger.reportDebug("getblocktemplate failed! %s" % e)
+			return False
+	
+	# Returns the coinbase transaction for extranonce, without and with its
+	# witness; the first is hashed into the merkle root, the second goes in the block.
+	def buildCoinbase(self, template, extranonce):
+		script = heightScript(template['height']) + extranonce + self.COINBASE_TAG
+		inputs = varint(1) + '\x00' * 32 + '\xff' * 4 + varint(len(script)) + script + '\xff' * 4
+
+		outputs = [(template['coinbasevalue'], self.payout_script)]
+		commitment = template.get('default_witness_commitment')
+		if commitment is not None:
+			outputs.append((0, commitment.decode('hex')))
+		outputs = varint(len(outputs)) + ''.join(pack('<Q', value) + varint(len(s)) + s for (value, s) in outputs)
+
+		coinbase = pack('<I', 1) + inputs + outputs + pack('<I', 0)
+		if commitment is None:
+			return (coinbase, coinbase)
+
+		# Segwit blocks: the coinbase's witness is the 32-byte witness reserved value.
+		witness = varint(1) + varint(32) + '\x00' * 32
+		return (coinbase, pack('<I', 1) + '\x00\x01' + inputs + outputs + witness + pack('<I', 0))
+	
+	# Generate a new unit of work from the current template, or None if there isn't one.
+	def makeWork(self):
+		with self.template_lock:
+			template = self.template
+			if template is None:
+				return None
+			extranonce = pack('<Q', self.extranonce)
+			self.extranonce += 1
+			branch = self.branch
+			ntime = template['curtime'] + int(time.time() - self.template_time)
+
+		(coinbase, block_coinbase) = self.buildCoinbase(template, extranonce)
+		header = makeHeader(template['version'], template['previousblockhash'].decode('hex')[::-1],
+		                    merkleRoot(coinbase, branch), ntime, int(template['bits'], 16))
+		work = makeWork(header, int(template['target'], 16))
+
+		with self.template_lock:
+			self.works[work['data'][:152]] = (header, block_coinbase, template)
+			if len(self.works) > self.MAX_WORK_RECORDS:
+				self.works.popitem(last=False)
+
+		return work
+	
+	def getNewJob(self, fpga, work=None):
+		if work is None:
+			if self.template is None or time.time() - self.template_time > self.TEMPLATE_REFRESH:
+				if not self.fetchTemplate() and self.template is None:
+					self.logger.log("%d: Error getting work! Retrying..." % fpga.id)
+					fpga.last_job = None
+					return False
+			work = self.makeWork()
+		
+		return RPCClient.getNewJob(self, fpga, work)
+	
+	def sendGold(self, gold):
+		with self.template_lock:
+			record = self.works.get(gold.job.data[:152])
+		if record is None:
+			self.logger.reportFound(hex(gold.nonce)[2:], False, gold.fpgaID)
+			return True
+
+		(header, coinbase, template) = record
+		header = header[:76] + pack('>I', gold.nonce)
+		transactions = template['transactions']
+		block = header + varint(1 + len(transactions)) + coinbase + ''.join(tx['data'].decode('hex') for tx in transactions)
+
+		try:
+			result = self.call(self.submit_pool, 'submitblock', [block.encode('hex')])
+		except (RPCError, IOError, ValueError, httplib.HTTPException) as e:
+			self.logger.reportDebug("%d: submitblock failed! %s" % (gold.fpgaID, e))
+			return False
+
+		# submitblock returns null on success, and the reason otherwise.
+		if result is not None:
+			self.logger.reportDebug("%d: Block rejected: %s" % (gold.fpgaID, result))
+		else:
+			self.logger.log("%d: Found block %s!" % (gold.fpgaID, doubleSha(header)[::-1].encode('hex')))
+		self.logger.reportFound(hex(gold.nonce)[2:], result is None, gold.fpgaID)
+		return True
+	
+	# bitcoind's long poll: getblocktemplate with the current template's
+	# longpollid returns when the template changes.
+	def longpoll_loop(self):
+		while True:
+			self.template_ready.wait()
+			with self.template_lock:
+				longpollid = self.template.get('longpollid')
+			if longpollid is None:
+				return
+
+			request = dict(self.GBT_REQUEST)
+			request['longpollid'] = longpollid
+			try:
+				self.long_poll_active = True
+				template = self.call(self.lp_pool, 'getblocktemplate', [request])
+				self.long_poll_active = False
+				new_block = self.setTemplate(template)
+			except (RPCError, IOError, ValueError, KeyError, httplib.HTTPException) as e:
+				self.long_poll_active = False
+				self.logger.reportLongPoll('error! %s' % e)
+				time.sleep(self.LONG_POLL_RETRY_DELAY)
+				continue
+
+			if new_block:
+				self.logger.reportLongPoll('new block %s' % template['previousblockhash'])
+				self.queue_work(self.makeWork())
+
+
+# Self-check against a stand-in bitcoind: fetch a block template, build work
+# from it, and submit a block once a nonce meets the target. The stand-in
+# takes the block apart on its own (coinbase, BIP 34 height, witness,
+# merkle root, header) and only accepts it if it all checks out.
+if __name__ == '__main__':
+	import os
+	from Queue import Queue, Empty
+	from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+	from SocketServer import ThreadingMixIn
+	from threading import Thread
+	from NonceCheck import JobHeader, hash2int
+	from json import loads
+	from BlockHeader import bitsTarget
+	
+	# Transactions only give a txid, as newer bitcoinds may. The target is hard
+	# enough that a wrongly serialized header is all but sure to miss it.
+	transactions = [os.urandom(60 + i) for i in range(3)]
+	template = {'version': 0x20000000, 'previousblockhash': os.urandom(32).encode('hex'), 'height': 300,
+	            'curtime': 1600000000, 'bits': '1f00ffff', 'target': '%064x' % bitsTarget(0x1f00ffff),
+	            'coinbasevalue': 5000000000, 'default_witness_commitment': '6a24aa21a9ed' + '11' * 32,
+	            'transactions': [{'data': tx.encode('hex'), 'txid': doubleSha(tx)[::-1].encode('hex')} for tx in transactions]}
+	
+	# Check a block the way bitcoind would, returning None or the reason it's rejected.
+	def checkBlock(block):
+		(header, body) = (block[:80], block[80:])
+		tx_data = ''.join(transactions)
+		if body[0] != chr(1 + len(transactions)) or not body.endswith(tx_data):
+			return 'bad-txns'
+		coinbase = body[1:len(body) - len(tx_data)]
+		# The coinbase has a witness (marker, flag, and one 32-byte item); its txid doesn't cover it.
+		if coinbase[4:6] != '\x00\x01' or coinbase[-38:-4] != '\x01\x20' + '\x00' * 32:
+			return 'bad-witness'
+		stripped = coinbase[:4] + coinbase[6:-38] + coinbase[-4:]
+		# The script starts after the input count, prevout and script length.
+		if stripped[42:45] != '\x02\x2c\x01':
+			return 'bad-cb-height'
+		if pack('<Q', template['coinbasevalue']) not in stripped or template['default_witness_commitment'].decode('hex') not in stripped:
+			return 'bad-cb-outputs'
+		hashes = [doubleSha(stripped)] + [doubleSha(tx) for tx in transactions]
+		while len(hashes) > 1:
+			if len(hashes) % 2 == 1:
+				hashes.append(hashes[-1])
+			hashes = [doubleSha(hashes[i] + hashes[i+1]) for i in range(0, len(hashes), 2)]
+		if header[36:68] != hashes[0]:
+			return 'bad-txnmrklroot'
+		if header[4:36] != template['previousblockhash'].decode('hex')[::-1]:
+			return 'bad-prevblk'
+		if hash2int(doubleSha(header)) > bitsTarget(int(template['bits'], 16)):
+			return 'high-hash'
+		return None
+	
+	results = Queue()
+	class Bitcoind(BaseHTTPRequestHandler):
+		def log_message(self, *args):
+			pass
+		def do_POST(self):
+			request = loads(self.rfile.read(int(self.headers['Content-Length'])))
+			if request['method'] == 'getblocktemplate':
+				result = template
+			elif request['method'] == 'submitblock':
+				result = checkBlock(request['params'][0].decode('hex'))
+				results.put(result)
+			response = dumps({'result': result, 'error': None, 'id': request['id']})
+			self.send_response(200)
+			self.send_header('Content-Length', str(len(response)))
+			self.end_headers()
+			self.wfile.write(response)
+	class Server(ThreadingMixIn, HTTPServer):
+		daemon_threads = True
+	server = Server(('127.0.0.1', 0), Bitcoind)
+	thread = Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+	
+	class Object(object):
+		pass
+	
+	found = Queue()
+	class Logger:
+		def reportFound(self, hash, accepted, fpgaID):
+			found.put(accepted)
+		def __getattr__(self, name):
+			return lambda *args, **kwargs: None
+	
+	class FPGA:
+		def __init__(self):
+			self.id = 0
+			self.last_job = None
+			self.jobqueue = Queue()
+		def getJob(self, timeout=None):
+			try:
+				return self.jobqueue.get(timeout is not None, timeout)
+			except Empty:
+				return None
+		def putJob(self, work):
+			job = Object()
+			job.data = work['data']
+			job.header = JobHeader(work['data'], work['target'])
+			self.jobqueue.put(job)
+		def nonceSpaceTime(self):
+			return 60
+	
+	settings = Object()
+	settings.url = '127.0.0.1:%d' % server.server_address[1]
+	settings.worker = 'user:pass'
+	settings.getwork_interval = 20
+	settings.coinbase_addr = 'mipcBbFg9gMiCh81Kj8tqqdgoZub1ZJRfn'
+	goldqueue = Queue()
+	client = GBTClient(settings, Logger(), goldqueue)
+	fpga = FPGA()
+	client.fpga_list = [fpga]
+	client.start()
+	
+	gold = Object()
+	gold.fpgaID = 0
+	gold.job = fpga.getJob(10)
+	assert gold.job is not None, "No work from the stand-in bitcoind"
+	gold.nonce = 0
+	while not gold.job.header.check(gold.nonce)[1]:
+		gold.nonce += 1
+	goldqueue.put(gold)
+	
+	result = results.get(True, 10)
+	assert result is None, "Block rejected: %s" % result
+	assert found.get(True, 10) is True, "Block not reported as accepted"
+	
+	print "OK: block at height %d accepted, nonce %08x" % (template['height'], gold.nonce)
+	# Don't wait for the client's threads, which never finish.
+	os._exit(0)
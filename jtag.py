@@ -26,6 +26,7 @@
 
 from TAP import TAP
 import time
+from threading import RLock
 
 
 class NoDevicesDetected(Exception): pass
@@ -33,6 +34,7 @@ class IDCodesNotRead(Exception): pass
 class ChainNotProperlyDetected(Exception): pass
 class InvalidChain(Exception): pass
 class WriteError(Exception): pass
+class CompileMismatch(Exception): pass
 
 class UnknownIDCode(Exception):
 	def __init__(self, idcode):
@@ -45,6 +47,20 @@ irlength_lut = {0x403d093: 6, 0x401d093: 6, 0x4008093: 6, 0x5057093: 16, 0x50590
 # LUT for device name based on ID code:
 name_lut = {0x403d093: 'Spartan 6 LX150T', 0x401d093: 'Spartan 6 LX150', 0x5059093: 'Unknown', 0x5057093: 'Unknown'}
 
+class JTAGSequence:
+	"""A precompiled stream of JTAG clocks, ready to be queued with JTAG.replay."""
+	def __init__(self, data, reads, state):
+		self.data = data	# Bytes for the FT232R's write buffer
+		self.reads = reads	# (offset, length) of each deferred shift_dr
+		self.state = state	# TAP state at the end of the sequence
+
+class _RecordingDevice:
+	"""Stands in for an FT232R, collecting clocks instead of sending them."""
+	def __init__(self, portlist):
+		self.portlist = portlist
+		self.write_buffer = ""
+		self.lock = RLock()
+
 class JTAG():
 	def __init__(self, ft232r, chain):
 		self.ft232r = ft232r
@@ -55,6 +71,7 @@ class JTAG():
 		self.current_instructions = [1] * 100	# Default is to put all possible devices into BYPASS. # TODO: Should be 1000
 		self.current_part = 0
 		self._tckcount = 0
+		self.deferred = []
 		self.portlist = ft232r.portlist.chain_portlist(chain)
 		self.debug = 0
 		
@@ -139,12 +156,17 @@ class JTAG():
 		return self.shift_ir(read=True)
 	
 	# TODO: Doesn't work correctly if not operating on the last device in the chain
-	def shift_dr(self, bits, read=False):
+	# If defer is True, the bits shifted out are read back later by read_deferred,
+	# which lets several scans share a single USB round trip.
+	def shift_dr(self, bits, read=False, defer=False):
 		self.tap.goto(TAP.SELECT_DR)
 		self.tap.goto(TAP.SHIFT_DR)
 
 		bits += [0] * self.current_part
 
+		if defer:
+			self.deferred.append((len(self.ft232r.write_buffer), len(bits) - self.current_part))
+
 		for bit in bits[:-1]:
 			self.jtagClock(tdi=bit)
 		self.jtagClock(tdi=bits[-1], tms=1)
@@ -158,6 +180,28 @@ class JTAG():
 	def read_dr(self, bits):
 		return self.shift_dr(bits, read=True)
 	
+	def read_deferred(self):
+		"""Read the data shifted out by every shift_dr(defer=True) since the last call.
+		Everything is read back in one transaction. Returns a list of bit arrays, in
+		the order the shifts were made. The caller must hold the FT232R lock from the
+		first deferred shift until this returns, and must not flush in between.
+		"""
+		deferred = self.deferred
+		self.deferred = []
+
+		if len(deferred) == 0:
+			return []
+
+		first = deferred[0][0]
+		bits = self.read_tdo((len(self.ft232r.write_buffer) - first) / 3)
+
+		results = []
+		for (position, length) in deferred:
+			offset = (position - first) / 3
+			results.append(bits[offset:offset+length])
+
+		return results
+	
 	def read_tdo(self, num):
 		"""Reads num bits from TDO, and returns the bits as an array."""
 		data = self.ft232r.read_data(num)
@@ -183,9 +227,13 @@ class JTAG():
 			self.ft232r._setAsyncMode()
 		
 		written = 0
-		bytetotal = 0
-		for chunk in processed_bitstream.chunks:
-			bytetotal += len(chunk) / 16
+		if hasattr(processed_bitstream, 'bytetotal'):
+			# Streamed bitstreams know their length up front (or not at all).
+			bytetotal = processed_bitstream.bytetotal or 0
+		else:
+			bytetotal = 0
+			for chunk in processed_bitstream.chunks:
+				bytetotal += len(chunk) / 16
 		
 		start_time = time.time()
 		last_update = 0
@@ -200,7 +248,8 @@ class JTAG():
 				progressCallback(start_time, time.time(), written, bytetotal)
 				last_update = time.time()
 		
-		progressCallback(start_time, time.time(), written, bytetotal)
+		if progressCallback:
+			progressCallback(start_time, time.time(), written, bytetotal)
 		
 		#print ""
 		#print "Loaded data in %d secs." % (time.time() - start_time)
@@ -216,6 +265,65 @@ class JTAG():
 		self.tap.goto(TAP.IDLE)
 		self.ft232r.flush()
 	
+	def compiler(self):
+		"""Return a JTAG object with this chain's configuration that records clocks
+		into its own buffer. Its compile method builds JTAGSequences without touching
+		the FT232R, so it can be used from other threads without holding the device lock.
+		"""
+		jtag = JTAG(_RecordingDevice(self.ft232r.portlist), self.chain)
+		jtag.deviceCount = self.deviceCount
+		jtag.idcodes = self.idcodes
+		jtag.irlengths = self.irlengths
+		if self.irlengths is not None:
+			jtag.current_instructions = [1] * sum(self.irlengths)
+		jtag.current_part = self.current_part
+		return jtag
+	
+	def compile(self, sequence, state=TAP.IDLE):
+		"""Run sequence(jtag), starting from the given TAP state, and return the
+		clocks it generated as a JTAGSequence.
+		"""
+		with self.ft232r.lock:
+			self.ft232r.write_buffer = ""
+			self.deferred = []
+			self.tap.state = state
+			try:
+				sequence(self)
+				return JTAGSequence(self.ft232r.write_buffer, self.deferred, self.tap.state)
+			finally:
+				self.ft232r.write_buffer = ""
+				self.deferred = []
+	
+	def checkCompiled(self, sequence, compiled, state=TAP.IDLE):
+		"""Run sequence(jtag) on this chain without sending anything, and raise
+		CompileMismatch unless it generates exactly the clocks in compiled.
+		"""
+		with self.ft232r.lock:
+			saved = (self.ft232r.write_buffer, self.deferred, self.tap.state, self.current_instructions)
+			self.ft232r.write_buffer = ""
+			self.deferred = []
+			self.current_instructions = list(self.current_instructions)
+			self.tap.state = state
+			try:
+				sequence(self)
+				data = self.ft232r.write_buffer
+			finally:
+				(self.ft232r.write_buffer, self.deferred, self.tap.state, self.current_instructions) = saved
+		
+		if data != compiled.data:
+			raise CompileMismatch("Compiled sequence is %d clocks, but the chain generates %d" % (len(compiled.data) / 3, len(data) / 3))
+	
+	def replay(self, sequence):
+		"""Queue a JTAGSequence compiled for this chain. The TAP must already be in
+		the state the sequence was compiled from.
+		"""
+		with self.ft232r.lock:
+			base = len(self.ft232r.write_buffer)
+			self.ft232r.write_buffer += sequence.data
+			for (offset, length) in sequence.reads:
+				self.deferred.append((base + offset, length))
+			self.tap.state = sequence.state
+	
 	def stressTest(self, testcount=100):
 		"""Run a stress test of the JTAG chain to make sure communications will run properly.
 		This amounts to running the readChain function a hundred times.
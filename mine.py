@@ -25,224 +25,266 @@ from ft232r import FT232R, FT232R_PortList
 from jtag import JTAG
 from ConsoleLogger import ConsoleLogger
 from rpcClient import RPCClient
+from stratumClient import StratumClient
+from gbtClient import GBTClient
 from fpga import FPGA
+from PollScheduler import PollScheduler
+from ClockTuner import ClockTuner, DEFAULT_MAX_CLOCK
+from NonceVerifier import NonceVerifier
+from ThermalMonitor import ThermalMonitor, SUSPENDED, DEFAULT_SOFT_LIMIT, DEFAULT_HARD_LIMIT
 import time
 from optparse import OptionParser
 import traceback
 from threading import Thread, Lock
 from Queue import Queue, Empty, Full
-from struct import pack, unpack
-from hashlib import sha256
-
-BASE_TARGET = 'ffffffffffffffffffffffffffffffffffffffffffffffffffffffff00000000'.decode('hex')
-
-# Option parsing:
-parser = OptionParser(usage="%prog [-d <devicenum>] [-c <chain>] -u <pool-url> -w <user:pass>")
-parser.add_option("-d", "--devicenum", type="int", dest="devicenum", default=None,
-                  help="Device number, optional. Opens the first available device by default")
-parser.add_option("-c", "--chain", type="int", dest="chain", default=2,
-                  help="JTAG chain number, can be 0, 1, or 2 for both FPGAs on the board (default 2)")
-parser.add_option("-i", "--interval", type="int", dest="getwork_interval", default=20,
-                  help="Getwork interval in seconds (default 20)")
-parser.add_option("-v", "--verbose", action="store_true", dest="verbose", default=False,
-                  help="Verbose logging")
-parser.add_option("-u", "--url", type="str", dest="url",
-                  help="URL for the pool or bitcoind server, e.g. pool.com:8337")
-parser.add_option("-w", "--worker", type="str", dest="worker",
-                  help="Worker username and password for the pool, e.g. user:pass")
-parser.add_option("-s", "--sleep", action="store_true", dest="sleep", default=False,
-                  help="Put FPGAs to sleep upon exit [EXPERIMENTAL]")
-parser.add_option("--overclock", type="int", dest="overclock", default=None,
-		  help="Set the FPGA's clocking speed (in MHz) [WARNING: Use with Extreme Caution]")
-settings, args = parser.parse_args()
-
-# Special error to make sure the user doesn't do something terrible
-if settings.overclock is not None and (settings.overclock > 300 or settings.overclock < 4):
-	print "ERROR: Overclock set too high!!! Please be careful with this setting, it could DAMAGE your Miner!!!"
-	parser.print_usage()
-	sys.exit()
-
 
 class Object(object):
 	pass
 	
-def checkTarget(target, hashOutput):
-	for t,h in zip(target[::-1], hashOutput[::-1]):
-		if ord(t) > ord(h):
-			return True
-		elif ord(t) < ord(h):
-			return False
-	return True
-
-def checkNonce(gold):
-	staticDataUnpacked = unpack('<' + 'I'*19, gold.job.data.decode('hex')[:76])
-	staticData = pack('>' + 'I'*19, *staticDataUnpacked)
-	hashInput = pack('>76sI', staticData, gold.nonce)
-	hashOutput = sha256(sha256(hashInput).digest()).digest()
-	
-	if checkTarget(BASE_TARGET, hashOutput):
-		logger.reportValid(gold.fpgaID)
-	else:
-		logger.reportError(hex(gold.nonce)[2:], gold.fpgaID)
-		return False
-	
-	if checkTarget(gold.job.target.decode('hex'), hashOutput):
-		return True
-	
-	return False
-	
 def handleNonce(job, nonce, fpgaID):
-	logger.reportNonce(fpgaID)
 	gold = Object()
 	gold.fpgaID = fpgaID
 	gold.job = job
 	gold.nonce = nonce & 0xFFFFFFFF
 	try:
-		noncequeue.put(gold, block=True, timeout=10)
+		if verifier.put(gold):
+			logger.reportNonce(fpgaID)
+		else:
+			logger.reportDuplicate(hex(gold.nonce)[2:], fpgaID)
 	except Full:
+		logger.reportNonce(fpgaID)
 		logger.log("%d: Queue full! Lost a nonce!" % fpgaID)
 
-def nonceLoop():
-	while True:
-		gold = noncequeue.get(block=True)
-		if checkNonce(gold):
-			try:
-				goldqueue.put(gold, block=True, timeout=10)
-				#logger.reportDebug("%d: goldqueue loaded (%d)" % (chain, goldqueue[chain].qsize()))
-			except Full:
-				logger.log("%d: Golden nonce queue full! Lost a golden nonce!" % gold.fpgaID)
-
-def mineLoop(fpga_list):
-	for fpga in fpga_list:
-		fpga.clearQueue()
+# Longest a worker blocks waiting for a job, so it notices when it should stop, in seconds.
+MAX_WAIT = 1.0
+
+# Each FPGA is driven by its own worker thread. Workers only share the
+# FT232R, whose lock every FPGA operation takes, so a slow operation on one
+# chain doesn't hold up polling on the other.
+def mineLoop(fpga):
+	fpga.clearQueue()
+	
+	scheduler = PollScheduler([fpga])
 	
 	while True:
 		if stop: return
 		
-		time.sleep(0.1)
+		if fpga.throttle == SUSPENDED:
+			# Drop its work; it gets fresh work once it has cooled down.
+			fpga.current_job = None
+			fpga.getJob(MAX_WAIT)
+			continue
 		
-		for fpga in fpga_list:
-			nonce = None
-			job = fpga.getJob()
-			
-			if job is not None:
-				#logger.reportDebug("%d: Loading new job..." % fpga.id)
-				if fpga.current_job is not None:
-					#logger.reportDebug("%d: Checking for nonce*..." % fpga.id)
-					nonce = fpga.readNonce()
-				#logger.reportDebug("%d: Writing job..." % fpga.id)
-				fpga.writeJob(job)
-				if nonce is not None:
-					handleNonce(fpga.current_job, nonce, fpga.id)
-				fpga.current_job = job
-			
+		# Wait for a new job until the next poll is due.
+		if fpga.current_job is None:
+			timeout = MAX_WAIT
+		else:
+			timeout = min(MAX_WAIT, max(0, scheduler.nextDeadline() - time.time()))
+		job = fpga.getJob(timeout)
+		start_time = time.time()
+		
+		if job is not None:
+			#logger.reportDebug("%d: Switching job..." % fpga.id)
+			nonces = fpga.switchJob(job)
 			if fpga.current_job is not None:
-				#logger.reportDebug("%d: Checking for nonce..." % fpga.id)
-				nonce = fpga.readNonce()
-				if nonce is not None:
+				for nonce in nonces:
 					handleNonce(fpga.current_job, nonce, fpga.id)
+			fpga.current_job = job
+			scheduler.polled(fpga, len(nonces), start_time)
+		elif fpga.current_job is not None and scheduler.due(fpga, start_time):
+			#logger.reportDebug("%d: Checking for nonce..." % fpga.id)
+			nonces = fpga.readNonces()
+			for nonce in nonces:
+				handleNonce(fpga.current_job, nonce, fpga.id)
+			scheduler.polled(fpga, len(nonces), start_time)
 
-if settings.url is None:
-	print "ERROR: URL not specified!"
-	parser.print_usage()
-	sys.exit()
-if settings.worker is None:
-	print "ERROR: Worker not specified!"
-	parser.print_usage()
-	sys.exit()
-
-fpga_list = []
+def startWorker(fpga):
+	worker = Thread(target=mineLoop, args=(fpga,))
+	worker.daemon = True
+	worker.start()
+	return worker
 
-goldqueue = Queue()
+if __name__ == '__main__':
+	# Option parsing:
+	parser = OptionParser(usage="%prog [-d <devicenum>] [-c <chain>] -u <pool-url> -w <user:pass>")
+	parser.add_option("-d", "--devicenum", type="int", dest="devicenum", default=None,
+	                  help="Device number, optional. Opens the first available device by default")
+	parser.add_option("-c", "--chain", type="int", dest="chain", default=2,
+	                  help="JTAG chain number, can be 0, 1, or 2 for both FPGAs on the board (default 2)")
+	parser.add_option("-i", "--interval", type="int", dest="getwork_interval", default=20,
+	                  help="Getwork interval in seconds, for FPGAs whose clock speed is unknown (default 20)")
+	parser.add_option("-v", "--verbose", action="store_true", dest="verbose", default=False,
+	                  help="Verbose logging")
+	parser.add_option("-u", "--url", type="str", dest="url",
+	                  help="URL for the pool or bitcoind server, e.g. pool.com:8337, or stratum+tcp://pool.com:3333 for a stratum pool")
+	parser.add_option("-w", "--worker", type="str", dest="worker",
+	                  help="Worker username and password for the pool, e.g. user:pass")
+	parser.add_option("-s", "--sleep", action="store_true", dest="sleep", default=False,
+	                  help="Put FPGAs to sleep upon exit [EXPERIMENTAL]")
+	parser.add_option("--verify-writes", action="store_true", dest="verify_writes", default=False,
+	                  help="Read back job data after loading it, and retry on a mismatch (needs firmware support)")
+	parser.add_option("--overclock", type="int", dest="overclock", default=None,
+			  help="Set the FPGA's clocking speed (in MHz) [WARNING: Use with Extreme Caution]")
+	parser.add_option("--autotune", action="store_true", dest="autotune", default=False,
+	                  help="Find the best clock speed for each FPGA by stepping it up while the error rate stays low, and remember it per board [WARNING: Use with Extreme Caution]")
+	parser.add_option("--max-clock", type="int", dest="max_clock", default=DEFAULT_MAX_CLOCK,
+	                  help="Highest clock speed (in MHz) --autotune will try (default %d)" % DEFAULT_MAX_CLOCK)
+	parser.add_option("--temp-soft", type="float", dest="temp_soft", default=DEFAULT_SOFT_LIMIT,
+	                  help="Temperature (in C) above which an FPGA's clock is lowered (default %d)" % DEFAULT_SOFT_LIMIT)
+	parser.add_option("--temp-hard", type="float", dest="temp_hard", default=DEFAULT_HARD_LIMIT,
+	                  help="Temperature (in C) above which an FPGA is put to sleep until it cools (default %d)" % DEFAULT_HARD_LIMIT)
+	parser.add_option("--no-thermal", action="store_false", dest="thermal", default=True,
+	                  help="Don't monitor the board's temperature sensors")
+	parser.add_option("--verify-processes", type="int", dest="verify_processes", default=0,
+	                  help="Check nonces in a pool of this many processes, for rigs with many boards (default 0, check them on a thread)")
+	parser.add_option("--gbt", action="store_true", dest="gbt", default=False,
+	                  help="Solo mine with getblocktemplate; the URL is bitcoind's RPC port")
+	parser.add_option("--coinbase-addr", type="str", dest="coinbase_addr", default=None,
+	                  help="Address block rewards are paid to with --gbt")
+	settings, args = parser.parse_args()
 
-logger = ConsoleLogger(settings.verbose)
-rpcclient = RPCClient(settings, logger, goldqueue)
+	# Special error to make sure the user doesn't do something terrible
+	if settings.overclock is not None and (settings.overclock > 300 or settings.overclock < 4):
+		print "ERROR: Overclock set too high!!! Please be careful with this setting, it could DAMAGE your Miner!!!"
+		parser.print_usage()
+		sys.exit()
+	if settings.max_clock > 300 or settings.max_clock < 4:
+		print "ERROR: Maximum clock set too high!!! Please be careful with this setting, it could DAMAGE your Miner!!!"
+		parser.print_usage()
+		sys.exit()
+	if settings.temp_soft >= settings.temp_hard:
+		print "ERROR: The soft temperature limit must be below the hard limit!"
+		parser.print_usage()
+		sys.exit()
 
-try:
-	# open FT232R
-	ft232r = FT232R()
-	portlist = FT232R_PortList(7, 6, 5, 4, 3, 2, 1, 0)
-	if ft232r.open(settings.devicenum, portlist):
-		logger.reportOpened(ft232r.devicenum, ft232r.serial)
-	else:
-		logger.log("ERROR: FT232R device not opened!", False)
+	if settings.url is None:
+		print "ERROR: URL not specified!"
+		parser.print_usage()
 		sys.exit()
-	
-	if settings.chain == 0 or settings.chain == 1:
-		fpga_list.append(FPGA(ft232r, settings.chain, logger))
-	elif settings.chain == 2:
-		fpga_list.append(FPGA(ft232r, 0, logger))
-		fpga_list.append(FPGA(ft232r, 1, logger))
-	else:
-		logger.log("ERROR: Invalid chain option!", False)
+	if settings.worker is None:
+		print "ERROR: Worker not specified!"
 		parser.print_usage()
 		sys.exit()
-	
-	logger.fpga_list = fpga_list
-	rpcclient.fpga_list = fpga_list
-	
-	for id, fpga in enumerate(fpga_list):
-		fpga.id = id
-		logger.reportDebug("Discovering FPGA %d..." % id, False)
-		fpga.detect()
+	if settings.gbt and settings.coinbase_addr is None:
+		print "ERROR: --gbt needs a --coinbase-addr to pay the block reward to!"
+		parser.print_usage()
+		sys.exit()
+
+	fpga_list = []
+
+	goldqueue = Queue()
+
+	logger = ConsoleLogger(settings.verbose)
+	# Start the verifier first, so any process pool is forked before other threads start.
+	verifier = NonceVerifier(logger, goldqueue, settings.verify_processes)
+	verifier.start()
+	logger.verifier = verifier
+	if settings.url.startswith(StratumClient.URL_PREFIX):
+		rpcclient = StratumClient(settings, logger, goldqueue)
+	elif settings.gbt:
+		try:
+			rpcclient = GBTClient(settings, logger, goldqueue)
+		except ValueError as e:
+			print "ERROR: %s" % e
+			sys.exit()
+	else:
+		rpcclient = RPCClient(settings, logger, goldqueue)
+
+	try:
+		# open FT232R
+		ft232r = FT232R()
+		portlist = FT232R_PortList(7, 6, 5, 4, 3, 2, 1, 0)
+		if ft232r.open(settings.devicenum, portlist):
+			logger.reportOpened(ft232r.devicenum, ft232r.serial)
+		else:
+			logger.log("ERROR: FT232R device not opened!", False)
+			sys.exit()
 		
-		logger.reportDebug("Found %i device%s:" % (fpga.jtag.deviceCount,
-			's' if fpga.jtag.deviceCount != 1 else ''), False)
-
-		if len(fpga.jtag.idcodes) > 0:
-			idcode = fpga.jtag.idcodes[-1]
-			msg = " FPGA" + str(id) + ": "
-			msg += JTAG.decodeIdcode(idcode)
-			msg += " - Firmware: rev " + str(fpga.firmware_rev)
-			msg += ", build " + str(fpga.firmware_build)
-			logger.reportDebug(msg, False)
-	
-	logger.log("Connected to %d FPGAs" % len(fpga_list), False)
+		if settings.chain == 0 or settings.chain == 1:
+			fpga_list.append(FPGA(ft232r, settings.chain, logger))
+		elif settings.chain == 2:
+			fpga_list.append(FPGA(ft232r, 0, logger))
+			fpga_list.append(FPGA(ft232r, 1, logger))
+		else:
+			logger.log("ERROR: Invalid chain option!", False)
+			parser.print_usage()
+			sys.exit()
+		
+		logger.fpga_list = fpga_list
+		rpcclient.fpga_list = fpga_list
+		
+		for id, fpga in enumerate(fpga_list):
+			fpga.id = id
+			logger.reportDebug("Discovering FPGA %d..." % id, False)
+			fpga.detect()
+			
+			logger.reportDebug("Found %i device%s:" % (fpga.jtag.deviceCount,
+				's' if fpga.jtag.deviceCount != 1 else ''), False)
+
+			if len(fpga.jtag.idcodes) > 0:
+				idcode = fpga.jtag.idcodes[-1]
+				msg = " FPGA" + str(id) + ": "
+				msg += JTAG.decodeIdcode(idcode)
+				msg += " - Firmware: rev " + str(fpga.firmware_rev)
+				msg += ", build " + str(fpga.firmware_build)
+				logger.reportDebug(msg, False)
+		
+		logger.log("Connected to %d FPGAs" % len(fpga_list), False)
 
-	if settings.overclock is not None:
 		for fpga in fpga_list:
-			fpga.setClockSpeed(settings.overclock)
+			fpga.verify_writes = settings.verify_writes
 
-	
-	for fpga in fpga_list:
-		clock_speed = fpga.readClockSpeed()
+		if settings.overclock is not None:
+			for fpga in fpga_list:
+				fpga.setClockSpeed(settings.overclock)
+
+		
+		thermal = None
+		if settings.thermal:
+			thermal = ThermalMonitor(ft232r, fpga_list, logger, settings.temp_soft, settings.temp_hard)
+		
+		for fpga in fpga_list:
+			clock_speed = fpga.readClockSpeed()
 
-		clock_speed = "???" if clock_speed is None else str(clock_speed)
+			clock_speed = "???" if clock_speed is None else str(clock_speed)
 
-		logger.log("FPGA %d is running at %sMHz" % (fpga.id, clock_speed), False)
-	
-	logger.start()
-	rpcclient.start()
-	
-	noncequeue = Queue()
-	nonceThread = Thread(target=nonceLoop)
-	nonceThread.daemon = True
-	nonceThread.start()
-	
-	stop = False
-	
-	mineThread = Thread(target=mineLoop, args=(fpga_list,))
-	mineThread.daemon = True
-	mineThread.start()
-	
-	while True:
-		time.sleep(1)
-		logger.updateStatus()
-		if mineThread is None or not mineThread.isAlive():
-			logger.log("Restarting minethread")
-			mineThread = Thread(target=mineLoop, args=(fpga_list,))
-			mineThread.daemon = True
-			mineThread.start()
-
-except KeyboardInterrupt:
-	stop = True
-	logger.lineLength += 2
-	pass
+			logger.log("FPGA %d is running at %sMHz" % (fpga.id, clock_speed), False)
+		
+		# Started once the clock speeds are known, so ramping starts from them.
+		tuner = None
+		if settings.autotune:
+			tuner = ClockTuner(fpga_list, ft232r.serial, logger, max_clock=settings.max_clock)
+			tuner.start()
+		
+		logger.start()
+		rpcclient.start()
+		
+		stop = False
+		
+		workers = [startWorker(fpga) for fpga in fpga_list]
+		
+		while True:
+			time.sleep(1)
+			logger.updateStatus()
+			if thermal is not None:
+				thermal.update()
+			if tuner is not None:
+				tuner.update()
+			for fpga in fpga_list:
+				if not workers[fpga.id].isAlive():
+					logger.log("%d: Restarting worker thread" % fpga.id)
+					workers[fpga.id] = startWorker(fpga)
 
-finally:
-	logger.log("Exiting...")
-	if settings.sleep:
-		for fpga in fpga_list:
-			fpga.sleep()
-	ft232r.close()
-	logger.printSummary(settings)
+	except KeyboardInterrupt:
+		stop = True
+		logger.lineLength += 2
+		pass
+
+	finally:
+		logger.log("Exiting...")
+		if settings.sleep:
+			for fpga in fpga_list:
+				fpga.sleep()
+		verifier.close()
+		ft232r.close()
+		logger.printSummary(settings)
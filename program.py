@@ -21,130 +21,176 @@
 # THE SOFTWARE.
 
 import sys
+import os
 from ft232r import FT232R, FT232R_PortList
 from jtag import JTAG
 from BitstreamReader import BitFile, BitFileReadError, BitFileMismatch
+from BitstreamCache import BitstreamCache, DEFAULT_CACHE_DIR
 from fpga import FPGA
 import time
 from optparse import OptionParser
 from ConsoleLogger import ConsoleLogger
 
-# Option parsing:
-parser = OptionParser(usage="%prog [-d <devicenum>] [-c <chain>] <path-to-bitstream-file>")
-parser.add_option("-d", "--devicenum", type="int", dest="devicenum", default=None,
-                  help="Device number, optional. Opens the first available device by default")
-parser.add_option("-c", "--chain", type="int", dest="chain", default=2,
-                  help="JTAG chain number, can be 0, 1, or 2 for both FPGAs on the board (default 2)")
-parser.add_option("-v", "--verbose", action="store_true", dest="verbose", default=False,
-                  help="Verbose logging")
-parser.add_option("-s", "--sleep", action="store_true", dest="sleep", default=False,
-                  help="Put FPGAs to sleep after programming [EXPERIMENTAL]")
-settings, args = parser.parse_args()
+def reportBitfile(bitfile):
+  logger.log("Bitstream file opened:", False)
+  logger.log(" Design Name: %s" % bitfile.designname, False)
+  logger.log(" Firmware: rev %d, build: %d" % (bitfile.rev, bitfile.build), False)
+  logger.log(" Part Name: %s" % bitfile.part, False)
+  logger.log(" Date: %s" % bitfile.date, False)
+  logger.log(" Time: %s" % bitfile.time, False)
+  if bitfile.length is not None:
+    logger.log(" Bitstream Length: %d" % bitfile.length, False)
 
-logger = ConsoleLogger(settings.verbose)
+if __name__ == '__main__':
+  # Option parsing:
+  parser = OptionParser(usage="%prog [-d <devicenum>] [-c <chain>] <path-to-bitstream-file-or-directory>")
+  parser.add_option("-d", "--devicenum", type="int", dest="devicenum", default=None,
+                    help="Device number, optional. Opens the first available device by default")
+  parser.add_option("-c", "--chain", type="int", dest="chain", default=2,
+                    help="JTAG chain number, can be 0, 1, or 2 for both FPGAs on the board (default 2)")
+  parser.add_option("-v", "--verbose", action="store_true", dest="verbose", default=False,
+                    help="Verbose logging")
+  parser.add_option("-s", "--sleep", action="store_true", dest="sleep", default=False,
+                    help="Put FPGAs to sleep after programming [EXPERIMENTAL]")
+  parser.add_option("-S", "--stream", action="store_true", dest="stream", default=False,
+                    help="Process the bitstream while programming, instead of pre-processing it first")
+  parser.add_option("--part", type="str", dest="part", default=None,
+                    help="Part name for headerless .bin bitstreams, e.g. 6slx150fgg484")
+  parser.add_option("--userid", type="str", dest="userid", default=None,
+                    help="UserID for headerless .bin bitstreams, e.g. 0x42240402")
+  parser.add_option("-j", "--jobs", type="int", dest="jobs", default=1,
+                    help="Number of processes used to pre-process the bitstream; more are faster on multi-core machines, but use about twice the memory (default 1)")
+  parser.add_option("--cache-dir", type="str", dest="cache_dir", default=DEFAULT_CACHE_DIR,
+                    help="Directory for caching pre-processed bitstreams (default %s)" % DEFAULT_CACHE_DIR)
+  parser.add_option("--cache-size", type="int", dest="cache_size", default=1024,
+                    help="Maximum size of the pre-processed bitstream cache, in MB (default 1024)")
+  settings, args = parser.parse_args()
 
-if len(args) == 0:
-  logger.log("ERROR: No bitstream file specified!", False)
-  parser.print_usage()
-  sys.exit()
-  
-### Bitfile ###
-bitfileName = args[0]
-logger.log("Opening bitstream file: " + bitfileName, False)
-bitfile = None
-
-try:
-  bitfile = BitFile.read(bitfileName)
-except BitFileReadError, e:
-  print e
-  sys.exit()
-
-logger.log("Bitstream file opened:", False)
-logger.log(" Design Name: %s" % bitfile.designname, False)
-logger.log(" Firmware: rev %d, build: %d" % (bitfile.rev, bitfile.build), False)
-logger.log(" Part Name: %s" % bitfile.part, False)
-logger.log(" Date: %s" % bitfile.date, False)
-logger.log(" Time: %s" % bitfile.time, False)
-logger.log(" Bitstream Length: %d" % len(bitfile.bitstream), False)
+  logger = ConsoleLogger(settings.verbose)
 
-fpga_list = []
-
-with FT232R() as ft232r:
-  portlist = FT232R_PortList(7, 6, 5, 4, 3, 2, 1, 0)
-  if ft232r.open(settings.devicenum, portlist):
-    logger.reportOpened(ft232r.devicenum, ft232r.serial)
-  else:
-    logger.log("ERROR: FT232R device not opened!", False)
-    sys.exit()
-  
-  if settings.chain == 0 or settings.chain == 1:
-    fpga_list.append(FPGA(ft232r, settings.chain, logger))
-  elif settings.chain == 2:
-    fpga_list.append(FPGA(ft232r, 0, logger))
-    fpga_list.append(FPGA(ft232r, 1, logger))
-  else:
-    logger.log("ERROR: Invalid chain option!", False)
+  if len(args) == 0:
+    logger.log("ERROR: No bitstream file specified!", False)
     parser.print_usage()
     sys.exit()
   
-  for id, fpga in enumerate(fpga_list):
-    fpga.id = id
-    logger.reportDebug("Discovering FPGA %d ..." % id, False)
-    fpga.detect()
+  userid = None
+  if settings.userid is not None:
+    try:
+      userid = int(settings.userid, 16)
+    except ValueError:
+      logger.log("ERROR: Invalid UserID %s, expected a hex number like 0x42240402!" % settings.userid, False)
+      parser.print_usage()
+      sys.exit()
     
-    logger.reportDebug("Found %i device%s:" % (fpga.jtag.deviceCount,
-      's' if fpga.jtag.deviceCount != 1 else ''), False)
+  ### Bitfile ###
+  bitfileName = args[0]
+  bitfile = None
+  bitfile_index = None
+
+  try:
+    if os.path.isdir(bitfileName):
+      # The bitstream is picked once we know which FPGA is attached.
+      logger.log("Scanning bitstream directory: " + bitfileName, False)
+      bitfile_index = BitFile.scan(bitfileName)
+      logger.log("Found %d usable bitstream files" % sum([len(x) for x in bitfile_index.values()]), False)
+    else:
+      logger.log("Opening bitstream file: " + bitfileName, False)
+      bitfile = BitFile.read(bitfileName, settings.part, userid)
+      reportBitfile(bitfile)
+  except BitFileReadError, e:
+    print e
+    sys.exit()
+
+  fpga_list = []
+
+  with FT232R() as ft232r:
+    portlist = FT232R_PortList(7, 6, 5, 4, 3, 2, 1, 0)
+    if ft232r.open(settings.devicenum, portlist):
+      logger.reportOpened(ft232r.devicenum, ft232r.serial)
+    else:
+      logger.log("ERROR: FT232R device not opened!", False)
+      sys.exit()
+    
+    if settings.chain == 0 or settings.chain == 1:
+      fpga_list.append(FPGA(ft232r, settings.chain, logger))
+    elif settings.chain == 2:
+      fpga_list.append(FPGA(ft232r, 0, logger))
+      fpga_list.append(FPGA(ft232r, 1, logger))
+    else:
+      logger.log("ERROR: Invalid chain option!", False)
+      parser.print_usage()
+      sys.exit()
     
-    if fpga.jtag.deviceCount > 1:
-      logger.log("Warning:", False)
-      logger.log("This software currently supports only one device per chain.", False)
-      logger.log("Only the last part will be programmed.", False)
+    for id, fpga in enumerate(fpga_list):
+      fpga.id = id
+      logger.reportDebug("Discovering FPGA %d ..." % id, False)
+      fpga.detect()
+      
+      logger.reportDebug("Found %i device%s:" % (fpga.jtag.deviceCount,
+        's' if fpga.jtag.deviceCount != 1 else ''), False)
+      
+      if fpga.jtag.deviceCount > 1:
+        logger.log("Warning:", False)
+        logger.log("This software currently supports only one device per chain.", False)
+        logger.log("Only the last part will be programmed.", False)
 
-    if fpga.jtag.deviceCount > 0:
-      idcode = fpga.jtag.idcodes[-1]
-      msg = " FPGA" + str(id) + ": "
-      msg += JTAG.decodeIdcode(idcode)
-      logger.reportDebug(msg, False)
-      if idcode & 0x0FFFFFFF != bitfile.idcode:
-        raise BitFileMismatch
-  
-  logger.log("Connected to %d FPGAs" % len(fpga_list), False)
-  
-  if settings.chain == 2:
-    jtag = JTAG(ft232r, settings.chain)
-    jtag.deviceCount = 1
-    jtag.idcodes = [bitfile.idcode]
-    jtag._processIdcodes()
-  else:
-    jtag = fpga_list[0].jtag
-  
-  if bitfile.processed[settings.chain]:
-    logger.log("Loading pre-processed bitstream...", False)
-    start_time = time.time()
-    processed_bitstream = BitFile.load_processed(bitfileName, settings.chain)
-    logger.log("Loaded pre-processed bitstream in %f seconds" % (time.time() - start_time), False)
-  else:
-    logger.log("Pre-processing bitstream for chain = %d..." % settings.chain, False)
-    start_time = time.time()
-    processed_bitstream = BitFile.pre_process(bitfile.bitstream, jtag, settings.chain, logger.updateProgress)
-    logger.log("Pre-processed bitstream in %f seconds" % (time.time() - start_time), False)
-    logger.log("Saving pre-processed bitstream...", False)
+      if fpga.jtag.deviceCount > 0:
+        idcode = fpga.jtag.idcodes[-1]
+        msg = " FPGA" + str(id) + ": "
+        msg += JTAG.decodeIdcode(idcode)
+        logger.reportDebug(msg, False)
+        if bitfile is None:
+          bitfile = BitFile.select(bitfile_index, idcode)
+          if bitfile is None:
+            raise BitFileMismatch("No bitstream in %s was built for this FPGA!" % bitfileName)
+          logger.log("Selected bitstream file: " + bitfile.name, False)
+          reportBitfile(bitfile)
+        if idcode & 0x0FFFFFFF != bitfile.idcode:
+          raise BitFileMismatch
+    
+    logger.log("Connected to %d FPGAs" % len(fpga_list), False)
+    
+    if settings.chain == 2:
+      jtag = JTAG(ft232r, settings.chain)
+      jtag.deviceCount = 1
+      jtag.idcodes = [bitfile.idcode]
+      jtag._processIdcodes()
+    else:
+      jtag = fpga_list[0].jtag
+    
+    if settings.stream:
+      logger.log("Streaming bitstream for chain = %d..." % settings.chain, False)
+      processed_bitstream = BitFile.stream_process(bitfile, jtag)
+    else:
+      cache = BitstreamCache(settings.cache_dir, settings.cache_size*1024*1024)
+      cache_key = BitstreamCache.key(bitfile.bitstream, portlist, settings.chain)
+      start_time = time.time()
+      processed_bitstream = cache.load(cache_key)
+      
+      if processed_bitstream is not None:
+        logger.log("Loaded pre-processed bitstream from cache in %f seconds" % (time.time() - start_time), False)
+      else:
+        logger.log("Pre-processing bitstream for chain = %d..." % settings.chain, False)
+        start_time = time.time()
+        processed_bitstream = BitFile.pre_process(bitfile.bitstream, jtag, settings.chain, logger.updateProgress, settings.jobs)
+        logger.log("Pre-processed bitstream in %f seconds" % (time.time() - start_time), False)
+        logger.log("Saving pre-processed bitstream...", False)
+        start_time = time.time()
+        cache.save(cache_key, processed_bitstream)
+        logger.log("Saved pre-processed bitstream in %f seconds" % (time.time() - start_time), False)
+    
+    logger.log("Beginning programming...", False)
+    if settings.chain == 2:
+      logger.log("Programming both FPGAs...", False)
+    else:
+      logger.log("Programming FPGA %d..." % settings.chain, False)
     start_time = time.time()
-    BitFile.save_processed(bitfileName, processed_bitstream, settings.chain)
-    logger.log("Saved pre-processed bitstream in %f seconds" % (time.time() - start_time), False)
-  
-  logger.log("Beginning programming...", False)
-  if settings.chain == 2:
-    logger.log("Programming both FPGAs...", False)
-  else:
-    logger.log("Programming FPGA %d..." % settings.chain, False)
-  start_time = time.time()
-  FPGA.programBitstream(ft232r, jtag, logger, processed_bitstream)
-  if settings.chain == 2:
-    logger.log("Programmed both FPGAs in %f seconds" % (time.time() - start_time), False)
-  else:
-    logger.log("Programmed FPGA %d in %f seconds" % (settings.chain, time.time() - start_time), False)
-  
-  if settings.sleep:
-    for fpga in fpga_list:
-      fpga.sleep()
+    FPGA.programBitstream(ft232r, jtag, logger, processed_bitstream)
+    if settings.chain == 2:
+      logger.log("Programmed both FPGAs in %f seconds" % (time.time() - start_time), False)
+    else:
+      logger.log("Programmed FPGA %d in %f seconds" % (settings.chain, time.time() - start_time), False)
+    
+    if settings.sleep:
+      for fpga in fpga_list:
+        fpga.sleep()
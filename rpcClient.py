@@ -1,267 +1,568 @@
-# Copyright (C) 2011 by fpgaminer <fpgaminer@bitcoin-mining.com>
-#                       fizzisist <fizzisist@fpgamining.com>
-#
-# Permission is hereby granted, free of charge, to any person obtaining a copy
-# of this software and associated documentation files (the "Software"), to deal
-# in the Software without restriction, including without limitation the rights
-# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
-# copies of the Software, and to permit persons to whom the Software is
-# furnished to do so, subject to the following conditions:
-#
-# The above copyright notice and this permission notice shall be included in
-# all copies or substantial portions of the Software.
-#
-# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
-# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
-# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
-# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
-# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
-# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
-# THE SOFTWARE.
-
-import httplib
-import socket
-import time
-from base64 import b64encode
-from json import dumps, loads
-from urlparse import urlsplit
-from threading import Thread
-from Queue import Empty
-from struct import pack
-
-class NotAuthorized(Exception): pass
-class RPCError(Exception): pass
-
-# Socket wrapper to enable socket.TCP_NODELAY and KEEPALIVE
-realsocket = socket.socket
-def socketwrap(family=socket.AF_INET, type=socket.SOCK_STREAM, proto=0):
-	sockobj = realsocket(family, type, proto)
-	sockobj.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-	sockobj.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-	return sockobj
-socket.socket = socketwrap
-
-class RPCClient:
-	
-	NUM_RETRIES = 5
-	
-	def __init__(self, settings, logger, goldqueue):
-		self.host = settings.url
-		self.getwork_interval = settings.getwork_interval
-		self.logger = logger
-		self.goldqueue = goldqueue
-		self.fpga_list = []
-		self.proto = "http"
-		self.postdata = {'method': 'getwork', 'id': 'json'}
-		self.headers = {"User-Agent": 'x6500-miner',
-		                "Authorization": 'Basic ' + b64encode(settings.worker),
-		                "Content-Type": 'application/json'
-		               }
-		self.timeout = 5
-		self.long_poll_timeout = 3600
-		self.long_poll_max_askrate = 60 - self.timeout
-		self.long_poll_active = False
-		self.long_poll_url = ''
-		self.lp_connection = None
-		self.connection = None
-		self.last_job = [None]*2
-		self.getwork_thread = None
-		self.longpoll_thread = None
-	
-	def start(self):
-		# Start getwork thread
-		self.getwork_thread = Thread(target=self.getwork_loop)
-		self.getwork_thread.daemon = True
-		self.getwork_thread.start()
-		
-		# Start long-polling thread:
-		self.longpoll_thread = Thread(target=self.longpoll_loop)
-		self.longpoll_thread.daemon = True
-		self.longpoll_thread.start()
-
-	def connect(self, proto, host, timeout):
-		if proto == 'https': connector = httplib.HTTPSConnection
-		else: connector = httplib.HTTPConnection
-		return connector(host, strict=True, timeout=timeout)
-
-	def request(self, connection, url, headers, data=None):
-		result = response = None
-		
-		try:
-			if data is not None:
-				connection.request('POST', url, data, headers)
-			else:
-				connection.request('GET', url, headers=headers)
-
-			response = connection.getresponse()
-
-			if response.status == httplib.UNAUTHORIZED:
-				raise NotAuthorized()
-			
-			self.long_poll_url = response.getheader('X-Long-Polling', '')
-			#self.logger.reportDebug('LP URL: %s' % self.long_poll_url)
-			
-			#self.miner.update_time = bool(response.getheader('X-Roll-NTime', ''))
-			
-			result = loads(response.read())
-
-			if result['error']:
-				raise RPCError(result['error']['message'])
-
-			return (connection, result)
-		finally:
-			if not result or not response or (response.version == 10 and response.getheader('connection', '') != 'keep-alive') or response.getheader('connection', '') == 'close':
-				connection.close()
-				connection = None
-
-	def failure(self, msg):
-		self.logger.log(msg)
-		exit()
-
-	def getwork(self, connection, fpgaID, data=None):
-		try:
-			if not connection:
-				self.logger.reportDebug("Connecting to server...")
-				connection = self.connect(self.proto, self.host, self.timeout)
-				self.logger.reportConnected(True)
-				#connection.set_debuglevel(1)
-			if data is None:
-				self.postdata['params']  = []
-				#self.logger.reportDebug("%d: Requesting work..." % fpgaID)
-			else:
-				self.postdata['params'] = [data]
-				#self.logger.reportDebug("%d: Submitting nonce..." % fpgaID)
-			(connection, result) = self.request(connection, '/', self.headers, dumps(self.postdata))
-			return (connection, result['result'])
-		except NotAuthorized:
-			self.failure('Wrong username or password.')
-		except RPCError as e:
-			self.logger.reportDebug("RPCError! %s" % e)
-			return (connection, e)
-		except IOError as e:
-			self.logger.reportDebug("IOError! %s" % e)
-		except ValueError as e:
-			self.logger.reportDebug("ValueError! %s" % e)
-		except httplib.HTTPException:
-			#self.logger.reportDebug("HTTP Error!")
-			pass
-		return (None, None)
-	
-	def getNewJob(self, fpga, work=None):
-		try:
-			# Empty the job queue:
-			while fpga.getJob() is not None:
-				pass
-			
-			if work is None:
-				(self.connection, work) = self.getwork(self.connection, fpga.id)
-			
-			fpga.putJob(work)
-			fpga.last_job = time.time()
-			return True
-		except:
-			self.logger.log("%d: Error getting work! Retrying..." % fpga.id)
-			fpga.last_job = None
-			return False
-
-	def sendGold(self, gold):
-		hexnonce = pack('I', long(gold.nonce)).encode('hex') # suggested by m0mchil
-		data = gold.job.data[:128+24] + hexnonce + gold.job.data[128+24+8:]
-		
-		(self.connection, accepted) = self.getwork(self.connection, gold.fpgaID, data)
-		if self.connection is None:
-			return False
-		
-		self.logger.reportFound(hex(gold.nonce)[2:], accepted, gold.fpgaID)
-		return True
-		
-	def queue_work(self, work):
-		# Empty the gold queue:
-		while True:
-			try:
-				self.goldqueue.get(False)
-			except Empty:
-				break
-		for fpga in self.fpga_list:
-			try:
-				# A long-poll event returns a new job, so load that one on the first chain:
-				self.getNewJob(fpga, work)
-				# Clear that job so that getNewJob will fetch a new one when called on subsequent chains:
-				work = None
-			except:
-				pass
-	
-	def getwork_loop(self):
-		for fpga in self.fpga_list:
-			self.getNewJob(fpga)
-		
-		while True:
-			time.sleep(0.1)
-			
-			for fpga in self.fpga_list:
-				if fpga.last_job is None or (time.time() - fpga.last_job) > self.getwork_interval:
-					self.getNewJob(fpga)
-			
-			gold = None
-			try:
-				gold = self.goldqueue.get(False)
-			except Empty:
-				gold = None
-
-			if gold is not None:
-				retries_left = self.NUM_RETRIES
-				success = self.sendGold(gold)
-				while not success and retries_left > 0:
-					self.logger.reportDebug("%d: Error sending nonce! Retrying..." % gold.fpgaID)
-					success = self.sendGold(gold)
-					retries_left -= 1
-				if not success:
-					self.logger.reportFound(hex(gold.nonce)[2:], False, gold.fpgaID)
-	
-	def longpoll_loop(self):
-		last_host = None
-		while True:
-			time.sleep(1)
-			url = self.long_poll_url
-			if url != '':
-				proto = self.proto
-				host = self.host
-				parsedUrl = urlsplit(url)
-				if parsedUrl.scheme != '':
-					proto = parsedUrl.scheme
-				if parsedUrl.netloc != '':
-					host = parsedUrl.netloc
-					url = url[url.find(host) + len(host):]
-					if url == '': url = '/'
-				try:
-					if host != last_host: self.close_lp_connection()
-					if not self.lp_connection:
-						self.lp_connection = self.connect(proto, host, self.long_poll_timeout)
-						self.logger.reportLongPoll("connected to %s" % host)
-						last_host = host
-					
-					self.long_poll_active = True
-					(self.lp_connection, result) = self.request(self.lp_connection, url, self.headers)
-					self.long_poll_active = False
-					self.logger.reportLongPoll('new block %s%s' % (result['result']['data'][56:64], result['result']['data'][48:56]))
-					self.queue_work(result['result'])
-					
-				except NotAuthorized:
-					self.logger.reportLongPoll('wrong username or password')
-				except RPCError as e:
-					self.logger.reportLongPoll('RPCError! %s' % e)
-				except IOError as e:
-					self.logger.reportLongPoll('IOError! %s' % e)
-					self.close_lp_connection()
-				except httplib.HTTPException:
-					self.logger.reportLongPoll('HTTPException!')
-					self.close_lp_connection()
-				except ValueError as e:
-					self.logger.reportLongPoll('ValueError! %s' % e)
-					self.close_lp_connection()
-					
-	def close_lp_connection(self):
-		if self.lp_connection:
-			self.lp_connection.close()
-			self.lp_connection = None
-
+# Copyright (C) 2011 by fpgaminer <fpgaminer@bitcoin-mining.com>
+#                       fizzisist <fizzisist@fpgamining.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import httplib
+import socket
+import time
+from select import select
+from base64 import b64encode
+from json import dumps, loads
+from urlparse import urlsplit
+from threading import Thread, Event, Lock
+from Queue import Queue, Empty
+from struct import pack
+
+class NotAuthorized(Exception): pass
+class RPCError(Exception): pass
+
+# Put on the gold queue to wake getwork_loop, e.g. when jobs need replacing.
+WAKEUP = object()
+
+# Socket wrapper to enable socket.TCP_NODELAY and KEEPALIVE
+realsocket = socket.socket
+def socketwrap(family=socket.AF_INET, type=socket.SOCK_STREAM, proto=0):
+	sockobj = realsocket(family, type, proto)
+	sockobj.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+	sockobj.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+	return sockobj
+socket.socket = socketwrap
+
+# Keep-alive HTTP connections to a server, for one kind of request. Idle
+# connections are reused if they still look alive; after a failure, new
+# connections are held back for an exponentially growing delay.
+class ConnectionPool:
+	
+	# Seconds to wait before reconnecting after a failure, doubled on each
+	# further failure up to the maximum
+	RECONNECT_DELAY = 0.1
+	MAX_RECONNECT_DELAY = 10
+	# Idle connections older than this (in seconds) are likely to have been
+	# dropped by the server, so they're closed instead of reused
+	MAX_IDLE = 15
+	
+	def __init__(self, connect, size):
+		self.connect = connect
+		self.size = size
+		self.lock = Lock()
+		# (connection, time released), most recently used last
+		self.idle = []
+		self.delay = 0
+		self.retry_time = 0
+	
+	# A keep-alive connection the server has closed polls as readable.
+	def healthy(self, connection, released):
+		if time.time() - released > self.MAX_IDLE:
+			return False
+		if connection.sock is None:
+			return True
+		try:
+			return select([connection.sock], [], [], 0)[0] == []
+		except (socket.error, ValueError):
+			return False
+	
+	# Get a connection, waiting out any reconnect delay. Give it back with release.
+	def acquire(self):
+		with self.lock:
+			delay = self.retry_time - time.time()
+		if delay > 0:
+			time.sleep(delay)
+		
+		with self.lock:
+			while len(self.idle) > 0:
+				(connection, released) = self.idle.pop()
+				if self.healthy(connection, released):
+					return connection
+				connection.close()
+		return self.connect()
+	
+	# Return a connection, or None if the request closed it. ok says whether
+	# the request got a response; if not, reconnecting is delayed.
+	def release(self, connection, ok):
+		with self.lock:
+			if ok:
+				self.delay = 0
+			else:
+				self.delay = min(self.MAX_RECONNECT_DELAY, max(self.RECONNECT_DELAY, 2 * self.delay))
+				self.retry_time = time.time() + self.delay
+			
+			if connection is not None and ok and len(self.idle) < self.size:
+				self.idle.append((connection, time.time()))
+			elif connection is not None:
+				connection.close()
+	
+	def close(self):
+		with self.lock:
+			for (connection, released) in self.idle:
+				connection.close()
+			self.idle = []
+
+class RPCClient:
+	
+	NUM_RETRIES = 5
+	# Seconds between attempts to get work after a failure
+	RETRY_DELAY = 0.1
+	# Seconds between long-poll attempts after a failure
+	LONG_POLL_RETRY_DELAY = 1
+	# Shortest and longest a job is kept, in seconds
+	MIN_JOB_LIFETIME = 1
+	MAX_JOB_LIFETIME = 120
+	# Weight of the newest getwork round trip in its moving average
+	FETCH_TIME_WEIGHT = 0.25
+	# How long rolled work stays valid if the server doesn't say, in seconds
+	DEFAULT_ROLL_EXPIRE = 60
+	# How far a rolled ntime may run ahead of the real time, in seconds
+	MAX_NTIME_AHEAD = 30
+	# Work units fetched ahead of time for each FPGA, so a new job doesn't wait on the pool
+	PREFETCH_DEPTH = 2
+	# Prefetched work older than this (in seconds) is thrown away instead of used
+	PREFETCH_MAX_AGE = 60
+	
+	def __init__(self, settings, logger, goldqueue):
+		self.host = settings.url
+		self.getwork_interval = settings.getwork_interval
+		self.logger = logger
+		self.goldqueue = goldqueue
+		self.fpga_list = []
+		self.proto = "http"
+		self.headers = {"User-Agent": 'x6500-miner',
+		                "Authorization": 'Basic ' + b64encode(settings.worker),
+		                "Content-Type": 'application/json'
+		               }
+		self.timeout = 5
+		self.long_poll_timeout = 3600
+		self.long_poll_max_askrate = 60 - self.timeout
+		self.long_poll_active = False
+		self.long_poll_url = ''
+		# Set while the server advertises a long-poll URL
+		self.long_poll_ready = Event()
+		self.lp_connection = None
+		# Separate connections for fetching work (getwork_loop and the
+		# prefetcher) and for submitting shares, so neither waits on the other
+		self.work_pool = ConnectionPool(self.newConnection, 2)
+		self.submit_pool = ConnectionPool(self.newConnection, 1)
+		# Shares waiting for submit_loop
+		self.submitqueue = Queue()
+		# Moving average of the getwork round trip, in seconds
+		self.fetch_time = 0.0
+		# The work unit jobs are rolled from: (work, time fetched, seconds valid)
+		self.roll_base = None
+		self.rolls = 0
+		self.roll_lock = Lock()
+		self.last_job = [None]*2
+		# Prefetched work for each FPGA id: lists of (work, time fetched, seconds
+		# it may be rolled for)
+		self.prefetched = {}
+		self.prefetch_lock = Lock()
+		# Bumped when a long poll brings a new block, so that fetches already
+		# in flight for the old one are dropped
+		self.prefetch_generation = 0
+		# Set when a buffer might need filling
+		self.prefetch_wanted = Event()
+		self.getwork_thread = None
+		self.submit_thread = None
+		self.longpoll_thread = None
+		self.prefetch_thread = None
+	
+	def start(self):
+		# Start getwork thread
+		self.getwork_thread = Thread(target=self.getwork_loop)
+		self.getwork_thread.daemon = True
+		self.getwork_thread.start()
+		
+		# Start share submission thread
+		self.submit_thread = Thread(target=self.submit_loop)
+		self.submit_thread.daemon = True
+		self.submit_thread.start()
+		
+		# Start long-polling thread:
+		self.longpoll_thread = Thread(target=self.longpoll_loop)
+		self.longpoll_thread.daemon = True
+		self.longpoll_thread.start()
+		
+		# Start work prefetching thread:
+		if self.PREFETCH_DEPTH > 0:
+			self.prefetch_thread = Thread(target=self.prefetch_loop)
+			self.prefetch_thread.daemon = True
+			self.prefetch_thread.start()
+
+	def newConnection(self):
+		self.logger.reportDebug("Connecting to server...")
+		connection = self.connect(self.proto, self.host, self.timeout)
+		self.logger.reportConnected(True)
+		#connection.set_debuglevel(1)
+		return connection
+
+	def connect(self, proto, host, timeout):
+		if proto == 'https': connector = httplib.HTTPSConnection
+		else: connector = httplib.HTTPConnection
+		return connector(host, strict=True, timeout=timeout)
+
+	# Returns (connection, result, roll_expire), where roll_expire is how many
+	# seconds work in this response may be rolled for (X-Roll-NTime).
+	def request(self, connection, url, headers, data=None):
+		result = response = None
+		
+		try:
+			if data is not None:
+				connection.request('POST', url, data, headers)
+			else:
+				connection.request('GET', url, headers=headers)
+
+			response = connection.getresponse()
+
+			if response.status == httplib.UNAUTHORIZED:
+				raise NotAuthorized()
+			
+			# Submit responses usually leave the header out, which mustn't
+			# clear the URL the long poll thread is using.
+			long_poll_url = response.getheader('X-Long-Polling', '')
+			if long_poll_url != '':
+				self.long_poll_url = long_poll_url
+				self.long_poll_ready.set()
+			#self.logger.reportDebug('LP URL: %s' % self.long_poll_url)
+			
+			roll_expire = self.parseRollNTime(response.getheader('X-Roll-NTime', ''))
+			
+			result = loads(response.read())
+
+			if result['error']:
+				raise RPCError(result['error']['message'])
+
+			return (connection, result, roll_expire)
+		finally:
+			if not result or not response or (response.version == 10 and response.getheader('connection', '') != 'keep-alive') or response.getheader('connection', '') == 'close':
+				connection.close()
+				connection = None
+
+	# X-Roll-NTime is either absent (or N) for no rolling, Y, or expire=<seconds>.
+	def parseRollNTime(self, header):
+		header = header.strip().lower()
+		if header in ('', 'n', '0'):
+			return 0
+		if header.startswith('expire='):
+			try:
+				return max(0, int(header[len('expire='):]))
+			except ValueError:
+				pass
+		return self.DEFAULT_ROLL_EXPIRE
+
+	def failure(self, msg):
+		self.logger.log(msg)
+		exit()
+
+	# Fetch work, or submit it if data is given, on a connection from pool.
+	# Returns (result, roll_expire) as for request; result is None if the
+	# request failed.
+	def getwork(self, pool, fpgaID, data=None):
+		postdata = {'method': 'getwork', 'id': 'json'}
+		if data is None:
+			postdata['params']  = []
+			#self.logger.reportDebug("%d: Requesting work..." % fpgaID)
+		else:
+			postdata['params'] = [data]
+			#self.logger.reportDebug("%d: Submitting nonce..." % fpgaID)
+		
+		connection = pool.acquire()
+		try:
+			(connection, result, roll_expire) = self.request(connection, '/', self.headers, dumps(postdata))
+			pool.release(connection, True)
+			return (result['result'], roll_expire)
+		except NotAuthorized:
+			pool.release(connection, True)
+			self.failure('Wrong username or password.')
+		except RPCError as e:
+			self.logger.reportDebug("RPCError! %s" % e)
+			# The server answered, so the connection is fine.
+			pool.release(connection, True)
+			return (e, 0)
+		except IOError as e:
+			self.logger.reportDebug("IOError! %s" % e)
+		except ValueError as e:
+			self.logger.reportDebug("ValueError! %s" % e)
+		except httplib.HTTPException:
+			#self.logger.reportDebug("HTTP Error!")
+			pass
+		pool.release(connection, False)
+		return (None, 0)
+	
+	def getNewJob(self, fpga, work=None):
+		try:
+			# Empty the job queue:
+			while fpga.getJob() is not None:
+				pass
+			
+			if work is None:
+				work = self.rollWork()
+			if work is None:
+				prefetched = self.takePrefetched(fpga)
+				if prefetched is not None:
+					(work, fetched, roll_expire) = prefetched
+				else:
+					start_time = time.time()
+					(work, roll_expire) = self.getwork(self.work_pool, fpga.id)
+					fetched = time.time()
+					self.fetch_time += self.FETCH_TIME_WEIGHT * (fetched - start_time - self.fetch_time)
+				self.setRollBase(work, fetched, roll_expire)
+			
+			fpga.putJob(work)
+			fpga.last_job = time.time()
+			return True
+		except:
+			self.logger.log("%d: Error getting work! Retrying..." % fpga.id)
+			fpga.last_job = None
+			return False
+
+	# Remember work, fetched at the given time, as the base for rolled jobs if
+	# the server allowed rolling it (for roll_expire seconds).
+	def setRollBase(self, work, fetched, roll_expire):
+		with self.roll_lock:
+			if isinstance(work, dict) and roll_expire > 0:
+				self.roll_base = (work, fetched, roll_expire)
+			else:
+				self.roll_base = None
+			self.rolls = 0
+	
+	# Make a new job from the roll base by advancing its ntime a second per job.
+	# ntime is in the header's second SHA-256 block, so the midstate is unchanged.
+	# Returns None once the base has expired, or when ntime would run too far
+	# ahead of the clock; it's time to fetch fresh work then.
+	def rollWork(self):
+		with self.roll_lock:
+			if self.roll_base is None:
+				return None
+
+			(work, fetched, expire) = self.roll_base
+			elapsed = time.time() - fetched
+			if elapsed >= expire or self.rolls + 1 > elapsed + self.MAX_NTIME_AHEAD:
+				self.roll_base = None
+				return None
+
+			self.rolls += 1
+			data = work['data']
+			# ntime is the 18th word of the header (bytes 68-71)
+			ntime = (int(data[136:144], 16) + self.rolls) & 0xFFFFFFFF
+
+			rolled = dict(work)
+			rolled['data'] = data[:136] + '%08x' % ntime + data[144:]
+			return rolled
+	
+	# The oldest usable prefetched work for fpga as (work, time fetched,
+	# seconds it may be rolled for), or None if its buffer is empty.
+	def takePrefetched(self, fpga):
+		prefetched = None
+		with self.prefetch_lock:
+			buffer = self.prefetched.get(fpga.id, [])
+			while prefetched is None and len(buffer) > 0:
+				prefetched = buffer.pop(0)
+				if time.time() - prefetched[1] > self.PREFETCH_MAX_AGE:
+					prefetched = None
+		self.prefetch_wanted.set()
+		return prefetched
+	
+	# Throw away all prefetched work, e.g. because a new block was found.
+	def clearPrefetched(self):
+		with self.prefetch_lock:
+			self.prefetched = {}
+			self.prefetch_generation += 1
+		self.prefetch_wanted.set()
+	
+	# The FPGA whose prefetch buffer is emptiest, or None if they're all full.
+	# Nothing is prefetched while jobs can be rolled locally instead.
+	def nextToPrefetch(self):
+		with self.roll_lock:
+			if self.roll_base is not None:
+				return None
+		
+		now = time.time()
+		fpga = None
+		with self.prefetch_lock:
+			for candidate in self.fpga_list:
+				buffer = self.prefetched.setdefault(candidate.id, [])
+				buffer[:] = [entry for entry in buffer if now - entry[1] <= self.PREFETCH_MAX_AGE]
+				if len(buffer) < self.PREFETCH_DEPTH and (fpga is None or len(buffer) < len(self.prefetched[fpga.id])):
+					fpga = candidate
+		return fpga
+	
+	# Keeps every FPGA's prefetch buffer full in the background. It has its
+	# own connection in the work pool, so it never waits on getwork_loop.
+	def prefetch_loop(self):
+		while True:
+			self.prefetch_wanted.clear()
+			fpga = self.nextToPrefetch()
+			if fpga is None:
+				# Also wake up in time to replace work that gets too old.
+				self.prefetch_wanted.wait(self.PREFETCH_MAX_AGE)
+				continue
+			
+			generation = self.prefetch_generation
+			start_time = time.time()
+			(work, roll_expire) = self.getwork(self.work_pool, fpga.id)
+			if not isinstance(work, dict):
+				time.sleep(self.RETRY_DELAY)
+				continue
+			fetched = time.time()
+			self.fetch_time += self.FETCH_TIME_WEIGHT * (fetched - start_time - self.fetch_time)
+			
+			with self.prefetch_lock:
+				if generation == self.prefetch_generation:
+					self.prefetched.setdefault(fpga.id, []).append((work, fetched, roll_expire))
+	
+	def sendGold(self, gold):
+		hexnonce = pack('I', long(gold.nonce)).encode('hex') # suggested by m0mchil
+		data = gold.job.data[:128+24] + hexnonce + gold.job.data[128+24+8:]
+		
+		accepted = self.getwork(self.submit_pool, gold.fpgaID, data)[0]
+		if accepted is None:
+			return False
+		
+		self.logger.reportFound(hex(gold.nonce)[2:], accepted, gold.fpgaID)
+		return True
+		
+	# Called by longpoll_loop with the new block's first job. That goes
+	# straight to the first FPGA; the others are marked as needing work, and
+	# getwork_loop is woken to fetch (or roll) it for them right away.
+	# roll_expire is how many seconds the server allows work to be rolled for.
+	def queue_work(self, work, roll_expire=0):
+		# Prefetched work is for the old block:
+		self.clearPrefetched()
+		# Empty the gold queue:
+		while True:
+			try:
+				self.goldqueue.get(False)
+			except Empty:
+				break
+		# Roll any further jobs from the new block's work.
+		self.setRollBase(work, time.time(), roll_expire)
+		for fpga in self.fpga_list:
+			try:
+				if work is not None:
+					self.getNewJob(fpga, work)
+					work = None
+				else:
+					while fpga.getJob() is not None:
+						pass
+					fpga.last_job = None
+			except:
+				pass
+		self.goldqueue.put(WAKEUP)
+	
+	# How long to keep a job on fpga: until just before it has searched the
+	# whole nonce range, allowing for the time it takes to fetch the next one.
+	# If the FPGA's clock speed is unknown, the getwork interval is used.
+	def jobLifetime(self, fpga):
+		exhaust_time = fpga.nonceSpaceTime()
+		if exhaust_time is None:
+			return self.getwork_interval
+		return max(self.MIN_JOB_LIFETIME, min(self.MAX_JOB_LIFETIME, exhaust_time - 2*self.fetch_time))
+	
+	# Sleeps until there is gold to submit or a job expires, rather than polling.
+	# Gold is handed to submit_loop, so submissions don't hold up new jobs.
+	def getwork_loop(self):
+		for fpga in self.fpga_list:
+			self.getNewJob(fpga)
+		
+		while True:
+			now = time.time()
+			timeout = None
+			for fpga in self.fpga_list:
+				if fpga.last_job is None:
+					expires = now + self.RETRY_DELAY
+				else:
+					expires = fpga.last_job + self.jobLifetime(fpga)
+				timeout = expires - now if timeout is None else min(timeout, expires - now)
+			
+			try:
+				gold = self.goldqueue.get(True, max(0, timeout))
+				if gold is not WAKEUP:
+					self.submitqueue.put(gold)
+			except Empty:
+				pass
+			
+			for fpga in self.fpga_list:
+				if fpga.last_job is None or (time.time() - fpga.last_job) >= self.jobLifetime(fpga):
+					self.getNewJob(fpga)
+	
+	def submit_loop(self):
+		while True:
+			gold = self.submitqueue.get()
+			retries_left = self.NUM_RETRIES
+			success = self.sendGold(gold)
+			while not success and retries_left > 0:
+				self.logger.reportDebug("%d: Error sending nonce! Retrying..." % gold.fpgaID)
+				success = self.sendGold(gold)
+				retries_left -= 1
+			if not success:
+				self.logger.reportFound(hex(gold.nonce)[2:], False, gold.fpgaID)
+	
+	def longpoll_loop(self):
+		last_host = None
+		while True:
+			self.long_poll_ready.wait()
+			url = self.long_poll_url
+			if url == '':
+				self.long_poll_ready.clear()
+			else:
+				proto = self.proto
+				host = self.host
+				parsedUrl = urlsplit(url)
+				if parsedUrl.scheme != '':
+					proto = parsedUrl.scheme
+				if parsedUrl.netloc != '':
+					host = parsedUrl.netloc
+					url = url[url.find(host) + len(host):]
+					if url == '': url = '/'
+				try:
+					if host != last_host: self.close_lp_connection()
+					if not self.lp_connection:
+						self.lp_connection = self.connect(proto, host, self.long_poll_timeout)
+						self.logger.reportLongPoll("connected to %s" % host)
+						last_host = host
+					
+					self.long_poll_active = True
+					(self.lp_connection, result, roll_expire) = self.request(self.lp_connection, url, self.headers)
+					self.long_poll_active = False
+					self.logger.reportLongPoll('new block %s%s' % (result['result']['data'][56:64], result['result']['data'][48:56]))
+					self.queue_work(result['result'], roll_expire)
+					
+				except NotAuthorized:
+					self.logger.reportLongPoll('wrong username or password')
+				except RPCError as e:
+					self.logger.reportLongPoll('RPCError! %s' % e)
+				except IOError as e:
+					self.logger.reportLongPoll('IOError! %s' % e)
+					self.close_lp_connection()
+				except httplib.HTTPException:
+					self.logger.reportLongPoll('HTTPException!')
+					self.close_lp_connection()
+				except ValueError as e:
+					self.logger.reportLongPoll('ValueError! %s' % e)
+					self.close_lp_connection()
+				else:
+					# Go straight back to waiting for the next block.
+					continue
+				
+				time.sleep(self.LONG_POLL_RETRY_DELAY)
+					
+	def close_lp_connection(self):
+		if self.lp_connection:
+			self.lp_connection.close()
+			self.lp_connection = None
+
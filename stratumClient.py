@@ -0,0 +1,362 @@
+# Copyright (C) 2011 by fpgaminer <fpgaminer@bitcoin-mining.com>
+#                       fizzisist <fizzisist@fpgamining.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+# A client for the stratum mining protocol: line-delimited JSON-RPC over TCP.
+#
+# The pool pushes jobs (mining.notify) rather than us asking for work, and
+# every unit of work is generated here by bumping extranonce2 in the coinbase
+# transaction and rebuilding the merkle root, header and midstate. Only
+# shares go back to the pool, and they're submitted without waiting for the
+# answer, which the reader thread reports when it arrives.
+#
+# Job scheduling (getwork_loop, job lifetimes, long-poll style job pushes)
+# is shared with RPCClient; only where work comes from and where shares go
+# is different.
+
+import socket
+import time
+from json import dumps, loads
+from threading import Thread, Lock
+from collections import OrderedDict
+from itertools import count
+from struct import pack
+from rpcClient import RPCClient
+from BlockHeader import merkleRoot, makeHeader, makeWork, swap32, difficultyTarget
+
+class StratumClient(RPCClient):
+	
+	URL_PREFIX = 'stratum+tcp://'
+	# Work units remembered so that shares can be matched to their job
+	MAX_WORK_RECORDS = 1024
+	# Seconds between reconnect attempts, doubled on each failure up to the maximum
+	RECONNECT_DELAY = 1
+	MAX_RECONNECT_DELAY = 60
+	# Work is built locally, so there is nothing to fetch ahead
+	PREFETCH_DEPTH = 0
+	
+	def __init__(self, settings, logger, goldqueue):
+		RPCClient.__init__(self, settings, logger, goldqueue)
+		
+		address = settings.url[len(self.URL_PREFIX):] if settings.url.startswith(self.URL_PREFIX) else settings.url
+		(host, sep, port) = address.rstrip('/').rpartition(':')
+		if sep == '':
+			raise ValueError("A stratum URL needs a port, e.g. %spool.com:3333" % self.URL_PREFIX)
+		self.address = (host, int(port))
+		self.username = settings.worker.split(':', 1)[0]
+		self.password = settings.worker.split(':', 1)[1] if ':' in settings.worker else ''
+		
+		self.sock = None
+		self.send_lock = Lock()
+		self.ids = count(1)
+		# Callbacks for requests still waiting for a response, by request id
+		self.pending = {}
+		
+		self.job_lock = Lock()
+		self.job = None
+		self.extranonce1 = None
+		self.extranonce2_size = 0
+		self.extranonce2 = 0
+		self.difficulty = 1
+		# (job id, extranonce2, ntime) for each work unit handed out, by the header it produced
+		self.works = OrderedDict()
+		
+		self.stratum_thread = None
+	
+	def start(self):
+		self.stratum_thread = Thread(target=self.stratum_loop)
+		self.stratum_thread.daemon = True
+		self.stratum_thread.start()
+		
+		self.getwork_thread = Thread(target=self.getwork_loop)
+		self.getwork_thread.daemon = True
+		self.getwork_thread.start()
+		
+		self.submit_thread = Thread(target=self.submit_loop)
+		self.submit_thread.daemon = True
+		self.submit_thread.start()
+	
+	# Connect, subscribe and authorize, then handle messages until the
+	# connection drops. Repeats forever, backing off between failed attempts.
+	def stratum_loop(self):
+		delay = self.RECONNECT_DELAY
+		while True:
+			try:
+				self.logger.reportDebug("Connecting to %s:%d..." % self.address)
+				sock = socket.create_connection(self.address, self.timeout)
+				sock.settimeout(None)
+				with self.send_lock:
+					self.sock = sock
+				self.logger.reportConnected(True)
+				
+				self.send('mining.subscribe', ['x6500-miner'], self.onSubscribe)
+				self.send('mining.authorize', [self.username, self.password], self.onAuthorize)
+				
+				for line in sock.makefile('rb'):
+					if line.strip() != '':
+						self.handleMessage(loads(line))
+						delay = self.RECONNECT_DELAY
+				
+				self.logger.reportDebug("Connection closed by server")
+			except (socket.error, ValueError, KeyError, IndexError, TypeError) as e:
+				self.logger.reportDebug("Stratum error! %s" % e)
+			
+			self.disconnect()
+			self.logger.reportConnected(False)
+			self.logger.reportConnectionFailed()
+			time.sleep(delay)
+			delay = min(self.MAX_RECONNECT_DELAY, delay * 2)
+	
+	def disconnect(self):
+		with self.send_lock:
+			if self.sock is not None:
+				try:
+					self.sock.close()
+				except socket.error:
+					pass
+			self.sock = None
+			self.pending = {}
+		
+		# Work from the old session can't be submitted on a new one.
+		with self.job_lock:
+			self.job = None
+			self.extranonce1 = None
+			self.works.clear()
+	
+	# Send a request; callback(result, error) is called from the reader thread
+	# with the response. Returns False if it couldn't be sent.
+	def send(self, method, params, callback=None):
+		with self.send_lock:
+			if self.sock is None:
+				return False
+			id = self.ids.next()
+			self.pending[id] = callback
+			try:
+				self.sock.sendall(dumps({'id': id, 'method': method, 'params': params}) + '\n')
+			except socket.error as e:
+				self.logger.reportDebug("Stratum error! %s" % e)
+				del self.pending[id]
+				return False
+		return True
+	
+	def handleMessage(self, message):
+		method = message.get('method')
+		
+		if method is None:
+			with self.send_lock:
+				callback = self.pending.pop(message.get('id'), None)
+			if callback is not None:
+				callback(message.get('result'), message.get('error'))
+		elif method == 'mining.notify':
+			self.onNotify(message['params'])
+		elif method == 'mining.set_difficulty':
+			with self.job_lock:
+				self.difficulty = message['params'][0]
+			self.logger.reportDebug("Stratum difficulty set to %s" % message['params'][0])
+		elif method == 'client.show_message':
+			self.logger.reportMsg(message['params'][0])
+		else:
+			self.logger.reportDebug("Ignoring stratum method %s" % method)
+	
+	def onSubscribe(self, result, error):
+		if error is not None:
+			self.logger.log("Stratum subscribe failed: %s" % (error,))
+			return
+		with self.job_lock:
+			self.extranonce1 = result[1]
+			self.extranonce2_size = result[2]
+			self.extranonce2 = 0
+	
+	def onAuthorize(self, result, error):
+		if result is not True:
+			self.failure('Wrong username or password.')
+	
+	def onNotify(self, params):
+		(job_id, prevhash, coinb1, coinb2, branches, version, nbits, ntime, clean) = params[:9]
+		
+		with self.job_lock:
+			new = self.job is None
+			self.job = (job_id, swap32(prevhash.decode('hex')), coinb1, coinb2,
+			            [branch.decode('hex') for branch in branches], int(version, 16), int(nbits, 16), ntime)
+		
+		if clean or new:
+			self.logger.log('New job %s from the pool' % job_id)
+			self.queue_work(self.makeWork())
+	
+	# Generate a new unit of work from the current job, or None if there's no job yet.
+	def makeWork(self):
+		with self.job_lock:
+			if self.job is None or self.extranonce1 is None:
+				return None
+			
+			(job_id, prevhash, coinb1, coinb2, branches, version, nbits, ntime) = self.job
+			extranonce2 = '%0*x' % (2*self.extranonce2_size, self.extranonce2)
+			self.extranonce2 = (self.extranonce2 + 1) % (1 << (8*self.extranonce2_size))
+			
+			coinbase = (coinb1 + self.extranonce1 + extranonce2 + coinb2).decode('hex')
+			header = makeHeader(version, prevhash, merkleRoot(coinbase, branches), int(ntime, 16), nbits)
+			work = makeWork(header, difficultyTarget(self.difficulty))
+			
+			self.works[work['data'][:152]] = (job_id, extranonce2, ntime)
+			if len(self.works) > self.MAX_WORK_RECORDS:
+				self.works.popitem(last=False)
+		
+		return work
+	
+	def getNewJob(self, fpga, work=None):
+		if work is None:
+			work = self.makeWork()
+		if work is None:
+			# No job from the pool yet; notify will bring one.
+			fpga.last_job = None
+			return False
+		
+		return RPCClient.getNewJob(self, fpga, work)
+	
+	def sendGold(self, gold):
+		with self.job_lock:
+			record = self.works.get(gold.job.data[:152])
+		if record is None:
+			# Its job is from an old session or long gone; the pool would reject it.
+			self.logger.reportFound(hex(gold.nonce)[2:], False, gold.fpgaID)
+			return True
+		
+		(job_id, extranonce2, ntime) = record
+		nonce = pack('<I', gold.nonce).encode('hex')
+		
+		def submitted(result, error):
+			if error is not None:
+				self.logger.reportDebug("%d: Share rejected: %s" % (gold.fpgaID, error))
+			self.logger.reportFound(hex(gold.nonce)[2:], result is True, gold.fpgaID)
+		
+		return self.send('mining.submit', [self.username, job_id, extranonce2, ntime, nonce], submitted)
+
+
+# Self-check against a stand-in pool: subscribe, authorize, take a job from
+# mining.notify, build work from it, and submit a nonce. The stand-in rebuilds
+# the header from the submitted extranonce2, ntime and nonce on its own, so
+# the byte order of every field is checked against what was hashed here.
+if __name__ == '__main__':
+	import os
+	from Queue import Queue, Empty
+	from hashlib import sha256
+	from NonceCheck import JobHeader, hash2int
+	
+	EXTRANONCE1 = 'f000000f'
+	EXTRANONCE2_SIZE = 4
+	job = ['job1', os.urandom(32).encode('hex'), os.urandom(41).encode('hex'), os.urandom(27).encode('hex'),
+	       [os.urandom(32).encode('hex') for i in range(3)], '20000000', '1d00ffff', '5f5e1000', True]
+	submits = Queue()
+	
+	def doubleSha(data):
+		return sha256(sha256(data).digest()).digest()
+	
+	# Rebuild the header the way a pool would, from the notify fields and a submit.
+	def poolHash(extranonce2, ntime, nonce):
+		(job_id, prevhash, coinb1, coinb2, branches, version, nbits) = job[:7]
+		root = doubleSha((coinb1 + EXTRANONCE1 + extranonce2 + coinb2).decode('hex'))
+		for branch in branches:
+			root = doubleSha(root + branch.decode('hex'))
+		# notify sends prevhash as eight 32-bit words, each byte swapped
+		prevhash = ''.join(prevhash.decode('hex')[i:i+4][::-1] for i in range(0, 32, 4))
+		header = version.decode('hex')[::-1] + prevhash + root + ntime.decode('hex')[::-1] + nbits.decode('hex')[::-1] + nonce.decode('hex')[::-1]
+		return hash2int(doubleSha(header))
+	
+	def servePool(conn):
+		def reply(message):
+			conn.sendall(dumps(message) + '\n')
+		for line in conn.makefile('rb'):
+			message = loads(line)
+			if message['method'] == 'mining.subscribe':
+				reply({'id': message['id'], 'result': [[], EXTRANONCE1, EXTRANONCE2_SIZE], 'error': None})
+			elif message['method'] == 'mining.authorize':
+				reply({'id': message['id'], 'result': True, 'error': None})
+				# Low enough that any nonce is a share
+				reply({'id': None, 'method': 'mining.set_difficulty', 'params': [1.0 / 2**32]})
+				reply({'id': None, 'method': 'mining.notify', 'params': job})
+			elif message['method'] == 'mining.submit':
+				submits.put(message['params'])
+				reply({'id': message['id'], 'result': True, 'error': None})
+	
+	server = socket.socket()
+	server.bind(('127.0.0.1', 0))
+	server.listen(1)
+	def acceptLoop():
+		(conn, address) = server.accept()
+		servePool(conn)
+	thread = Thread(target=acceptLoop)
+	thread.daemon = True
+	thread.start()
+	
+	class Object(object):
+		pass
+	
+	found = Queue()
+	class Logger:
+		def reportFound(self, hash, accepted, fpgaID):
+			found.put(accepted)
+		def __getattr__(self, name):
+			return lambda *args, **kwargs: None
+	
+	class FPGA:
+		def __init__(self):
+			self.id = 0
+			self.last_job = None
+			self.jobqueue = Queue()
+		def getJob(self, timeout=None):
+			try:
+				return self.jobqueue.get(timeout is not None, timeout)
+			except Empty:
+				return None
+		def putJob(self, work):
+			job = Object()
+			job.data = work['data']
+			job.header = JobHeader(work['data'], work['target'])
+			self.jobqueue.put(job)
+		def nonceSpaceTime(self):
+			return 60
+	
+	settings = Object()
+	settings.url = 'stratum+tcp://127.0.0.1:%d' % server.getsockname()[1]
+	settings.worker = 'worker.1:x'
+	settings.getwork_interval = 20
+	goldqueue = Queue()
+	client = StratumClient(settings, Logger(), goldqueue)
+	fpga = FPGA()
+	client.fpga_list = [fpga]
+	client.start()
+	
+	gold = Object()
+	gold.fpgaID = 0
+	gold.nonce = 0x12345678
+	gold.job = fpga.getJob(10)
+	assert gold.job is not None, "No work from the stand-in pool"
+	goldqueue.put(gold)
+	
+	(worker, job_id, extranonce2, ntime, nonce) = submits.get(True, 10)
+	assert (worker, job_id, ntime) == ('worker.1', 'job1', job[7])
+	assert len(extranonce2) == 2 * EXTRANONCE2_SIZE, "extranonce2 %s isn't %d bytes" % (extranonce2, EXTRANONCE2_SIZE)
+	assert poolHash(extranonce2, ntime, nonce) == gold.job.header.hash(gold.nonce), "The pool hashes a different header"
+	assert found.get(True, 10) is True, "Share not accepted"
+	
+	print "OK: share for job %s, extranonce2 %s, nonce %s" % (job_id, extranonce2, nonce)
+	# Don't wait for the client's threads, which never finish.
+	os._exit(0)